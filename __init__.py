@@ -1,18 +1,31 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
 from trytond.pool import Pool
+from . import analytics
 from . import operation
 from . import configuration
+from . import ir
+from . import work_center
 
 
 def register():
     Pool.register(
         configuration.Configuration,
+        ir.Cron,
         operation.Operation,
         operation.OperationTracking,
         operation.Production,
+        operation.Route,
+        operation.RouteOperation,
+        operation.Uom,
+        work_center.WorkCenter,
+        work_center.WorkCenterCategory,
+        work_center.WorkCenterLoad,
+        analytics.OperationAnalytics,
+        analytics.OperationAnalyticsContext,
         module='production_operation', type_='model')
     Pool.register(
+        ir.CronPurchaseRequest,
         operation.OperationSubcontrat,
         operation.PurchaseLine,
         operation.PurchaseRequest,
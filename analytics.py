@@ -0,0 +1,165 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from sql import Null
+from sql.aggregate import Count, Max, Min, Sum
+from sql.conditionals import Case, Coalesce, NullIf
+from sql.functions import DateTrunc
+
+from trytond.model import fields, ModelSQL, ModelView
+from trytond.pool import Pool
+from trytond.pyson import Eval, If
+from trytond.transaction import Transaction
+
+__all__ = ['OperationAnalytics', 'OperationAnalyticsContext']
+
+
+class OperationAnalytics(ModelSQL, ModelView):
+    'Operation Analytics'
+    __name__ = 'production.operation.analytics'
+
+    company = fields.Many2One('company.company', 'Company')
+    date = fields.Date('Date')
+    work_center = fields.Many2One('production.work_center', 'Work Center')
+    operation_type = fields.Many2One('production.operation.type',
+        'Operation Type')
+    operations = fields.Integer('Operations')
+    quantity = fields.Float('Quantity',
+        help='Quantity of the productions of the operations')
+    planned_hours = fields.Float('Planned Hours')
+    actual_hours = fields.Float('Actual Hours')
+    efficiency = fields.Float('Efficiency', digits=(16, 2),
+        help='Planned hours divided by actual hours')
+    throughput = fields.Float('Throughput', digits=(16, 2),
+        help='Quantity produced per actual hour')
+
+    @classmethod
+    def __setup__(cls):
+        super(OperationAnalytics, cls).__setup__()
+        cls._order.insert(0, ('date', 'ASC'))
+
+    @classmethod
+    def table_query(cls):
+        pool = Pool()
+        Operation = pool.get('production.operation')
+        Tracking = pool.get('production.operation.tracking')
+        RouteOperation = pool.get('production.route.operation')
+        Production = pool.get('production')
+        Uom = pool.get('product.uom')
+        context = Transaction().context
+
+        operation = Operation.__table__()
+        tracking = Tracking.__table__()
+        tracking_uom = Uom.__table__()
+        route_operation = RouteOperation.__table__()
+        production = Production.__table__()
+        time_uom = Uom.__table__()
+        quantity_uom = Uom.__table__()
+        production_uom = Uom.__table__()
+
+        # Time units are converted to hours which is the base unit
+        actual = (tracking
+            .join(tracking_uom, condition=tracking.uom == tracking_uom.id)
+            .select(
+                tracking.operation.as_('operation'),
+                Sum(tracking.quantity * tracking_uom.factor).as_('hours'),
+                group_by=[tracking.operation]))
+
+        time = route_operation.time * time_uom.factor
+        quantity = (production.quantity * production_uom.factor
+            / Coalesce(quantity_uom.factor, production_uom.factor))
+        planned = Case(
+            ((route_operation.calculation == 'standard')
+                & (Coalesce(route_operation.quantity, 0) != 0),
+                time * quantity / route_operation.quantity),
+            else_=Coalesce(time, 0))
+
+        date = Coalesce(production.effective_date, production.planned_date)
+        where = operation.state != 'cancelled'
+        if context.get('company'):
+            where &= production.company == context['company']
+        if context.get('from_date'):
+            where &= date >= context['from_date']
+        if context.get('to_date'):
+            where &= date <= context['to_date']
+        period_date = cls.date.sql_cast(
+            DateTrunc(context.get('period') or 'month', date))
+
+        # Aggregate first per production to count its quantity only once
+        productions = (operation
+            .join(production, condition=operation.production == production.id)
+            .join(production_uom, 'LEFT',
+                condition=production.unit == production_uom.id)
+            .join(actual, 'LEFT', condition=actual.operation == operation.id)
+            .join(route_operation, 'LEFT',
+                condition=operation.route_operation == route_operation.id)
+            .join(time_uom, 'LEFT',
+                condition=route_operation.time_uom == time_uom.id)
+            .join(quantity_uom, 'LEFT',
+                condition=route_operation.quantity_uom == quantity_uom.id)
+            .select(
+                Min(operation.id).as_('id'),
+                production.company.as_('company'),
+                period_date.as_('date'),
+                operation.work_center.as_('work_center'),
+                operation.operation_type.as_('operation_type'),
+                Count(operation.id).as_('operations'),
+                Max(production.quantity).as_('quantity'),
+                Sum(planned).as_('planned_hours'),
+                Sum(Coalesce(actual.hours, 0)).as_('actual_hours'),
+                where=where & (date != Null),
+                group_by=[production.company, period_date,
+                    operation.work_center, operation.operation_type,
+                    production.id]))
+
+        planned_hours = Sum(productions.planned_hours)
+        actual_hours = Sum(productions.actual_hours)
+        total_quantity = Sum(productions.quantity)
+        return productions.select(
+            Min(productions.id).as_('id'),
+            productions.company.as_('company'),
+            productions.date.as_('date'),
+            productions.work_center.as_('work_center'),
+            productions.operation_type.as_('operation_type'),
+            cls.operations.sql_cast(Sum(productions.operations)).as_(
+                'operations'),
+            cls.quantity.sql_cast(total_quantity).as_('quantity'),
+            cls.planned_hours.sql_cast(planned_hours).as_('planned_hours'),
+            cls.actual_hours.sql_cast(actual_hours).as_('actual_hours'),
+            cls.efficiency.sql_cast(
+                planned_hours / NullIf(actual_hours, 0)).as_('efficiency'),
+            cls.throughput.sql_cast(
+                total_quantity / NullIf(actual_hours, 0)).as_('throughput'),
+            group_by=[productions.company, productions.date,
+                productions.work_center, productions.operation_type])
+
+
+class OperationAnalyticsContext(ModelView):
+    'Operation Analytics Context'
+    __name__ = 'production.operation.analytics.context'
+
+    company = fields.Many2One('company.company', 'Company', required=True)
+    from_date = fields.Date('From Date',
+        domain=[
+            If(Eval('to_date') & Eval('from_date'),
+                ('from_date', '<=', Eval('to_date')),
+                ()),
+            ])
+    to_date = fields.Date('To Date',
+        domain=[
+            If(Eval('from_date') & Eval('to_date'),
+                ('to_date', '>=', Eval('from_date')),
+                ()),
+            ])
+    period = fields.Selection([
+            ('year', 'Year'),
+            ('month', 'Month'),
+            ('day', 'Day'),
+            ], 'Period', required=True)
+
+    @staticmethod
+    def default_company():
+        return Transaction().context.get('company')
+
+    @staticmethod
+    def default_period():
+        return Transaction().context.get('period', 'month')
@@ -1,5 +1,8 @@
+from trytond.cache import Cache
 from trytond.model import fields
 from trytond.pool import PoolMeta
+from trytond.pyson import Eval
+from trytond.transaction import Transaction
 
 __all__ = ['Configuration']
 
@@ -14,6 +17,19 @@ class Configuration(metaclass=PoolMeta):
         help='Check state operation when done a production')
     allow_done_production = fields.Boolean('Allow Done Produciton',
         help='Allow done the productoin when finish the last operation')
+    done_production_queue = fields.Boolean('Done Production in Queue',
+        states={
+            'invisible': ~Eval('allow_done_production'),
+            },
+        help='Done the production in a queue task when finish the last '
+        'operation')
+    process_purchase_queue = fields.Boolean('Process Purchase in Queue',
+        help='Process the subcontract purchases in a queue task when the '
+        'operation is done')
+    _operation_fields = ['check_state_operation', 'allow_done_production',
+        'done_production_queue', 'process_purchase_queue']
+    _operation_cache = Cache('production.configuration.operation',
+        context=False)
 
     @staticmethod
     def default_check_state_operation():
@@ -22,3 +38,37 @@ class Configuration(metaclass=PoolMeta):
     @staticmethod
     def default_allow_done_production():
         return True
+
+    @staticmethod
+    def default_done_production_queue():
+        return False
+
+    @staticmethod
+    def default_process_purchase_queue():
+        return False
+
+    @classmethod
+    def create(cls, vlist):
+        cls._operation_cache.clear()
+        return super(Configuration, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        cls._operation_cache.clear()
+        super(Configuration, cls).write(*args)
+
+    @classmethod
+    def delete(cls, configurations):
+        cls._operation_cache.clear()
+        super(Configuration, cls).delete(configurations)
+
+    @classmethod
+    def get_operation_configuration(cls):
+        "Return the operation configuration values for the context company"
+        key = Transaction().context.get('company')
+        values = cls._operation_cache.get(key)
+        if values is None:
+            config = cls(1)
+            values = {f: getattr(config, f) for f in cls._operation_fields}
+            cls._operation_cache.set(key, values)
+        return values.copy()
@@ -0,0 +1,158 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import functools
+import logging
+import time
+from collections import defaultdict, deque
+
+from trytond import config
+from trytond.transaction import Transaction
+
+__all__ = ['instrument', 'QueryCounter', 'stats', 'log_stats', 'reset']
+
+logger = logging.getLogger(__name__)
+
+ENABLED = config.getboolean(
+    'production_operation', 'instrumentation', default=False)
+SAMPLES = config.getint(
+    'production_operation', 'instrumentation_samples', default=1000)
+
+_samples = defaultdict(lambda: deque(maxlen=SAMPLES))
+
+
+class _CountingCursor(object):
+
+    def __init__(self, cursor, counter):
+        self._cursor = cursor
+        self._counter = counter
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __enter__(self):
+        self._cursor.__enter__()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        return self._cursor.__exit__(type, value, traceback)
+
+    def execute(self, *args, **kwargs):
+        self._counter.count += 1
+        return self._cursor.execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        self._counter.count += 1
+        return self._cursor.executemany(*args, **kwargs)
+
+
+class _CountingConnection(object):
+
+    def __init__(self, connection, counter):
+        self._connection = connection
+        self._counter = counter
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def cursor(self, *args, **kwargs):
+        return _CountingCursor(
+            self._connection.cursor(*args, **kwargs), self._counter)
+
+
+class QueryCounter(object):
+    """
+    Count the SQL queries executed on the transaction connection.
+
+    The connection is wrapped while the context manager is active so only
+    the cursors created inside it are counted.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self._connection = None
+
+    def __enter__(self):
+        transaction = Transaction()
+        self._connection = transaction.connection
+        transaction.connection = _CountingConnection(
+            self._connection, self)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        Transaction().connection = self._connection
+        self._connection = None
+
+
+def _record_count(args):
+    if not args:
+        return 0
+    if isinstance(args[0], type):
+        if len(args) > 1 and isinstance(args[1], (list, tuple)):
+            return len(args[1])
+        return 0
+    return 1
+
+
+def instrument(name):
+    "Record timing, query and record counts of the calls when enabled"
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return func(*args, **kwargs)
+            records = _record_count(args)
+            start = time.perf_counter()
+            with QueryCounter() as counter:
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    duration = time.perf_counter() - start
+                    _samples[name].append(
+                        (duration, counter.count, records))
+                    logger.debug('%s: %.6fs, %d queries, %d records',
+                        name, duration, counter.count, records)
+        return wrapper
+    return decorator
+
+
+def _percentile(values, percent):
+    values = sorted(values)
+    index = max(int(round(percent / 100 * len(values))) - 1, 0)
+    return values[index]
+
+
+def stats():
+    "Return the p50 and p95 of the recorded calls per name"
+    result = {}
+    for name, samples in list(_samples.items()):
+        if not samples:
+            continue
+        durations, queries, records = zip(*samples)
+        result[name] = {
+            'calls': len(samples),
+            'duration_p50': _percentile(durations, 50),
+            'duration_p95': _percentile(durations, 95),
+            'queries_p50': _percentile(queries, 50),
+            'queries_p95': _percentile(queries, 95),
+            'records_p50': _percentile(records, 50),
+            'records_p95': _percentile(records, 95),
+            }
+    return result
+
+
+def log_stats():
+    "Log the aggregated statistics"
+    for name, values in sorted(stats().items()):
+        logger.info('%s: %d calls, duration p50 %.6fs p95 %.6fs, '
+            'queries p50 %d p95 %d, records p50 %d p95 %d', name,
+            values['calls'], values['duration_p50'], values['duration_p95'],
+            values['queries_p50'], values['queries_p95'],
+            values['records_p50'], values['records_p95'])
+
+
+def reset():
+    "Clear the recorded calls"
+    _samples.clear()
@@ -0,0 +1,31 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from trytond.pool import PoolMeta
+
+__all__ = ['Cron', 'CronPurchaseRequest']
+
+
+class Cron(metaclass=PoolMeta):
+    __name__ = 'ir.cron'
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls.method.selection.extend([
+                ('production.operation|update_cost_cache',
+                    "Update Operation Cost Cache"),
+                ('production.work_center.load|rebuild',
+                    "Rebuild Work Center Load"),
+                ])
+
+
+class CronPurchaseRequest(metaclass=PoolMeta):
+    __name__ = 'ir.cron'
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls.method.selection.extend([
+                ('production.operation|generate_purchase_requests',
+                    "Generate Operation Purchase Requests"),
+                ])
@@ -1,20 +1,59 @@
+import csv
+import datetime
+import io
+import json
+from collections import defaultdict
+from contextlib import contextmanager
 from decimal import Decimal
-from trytond.model import (fields, ModelSQL, ModelView, Workflow,
+
+from sql import Null, Values
+from sql.aggregate import Max
+from sql.conditionals import Coalesce
+from sql.functions import CurrentTimestamp
+
+from trytond.cache import Cache
+from trytond.model import (fields, Index, ModelSQL, ModelView, Workflow,
     sequence_ordered)
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval, If, Id, Bool
-from trytond.transaction import Transaction
+from trytond.rpc import RPC
+from trytond.transaction import Transaction, without_check_access
 from trytond.i18n import gettext
 from trytond.exceptions import UserWarning, UserError
 from trytond.modules.product import round_price
+from trytond.tools import grouped_slice, reduce_ids
 
-__all__ = ['Operation', 'OperationTracking', 'Production']
+from .instrumentation import instrument
+from .scheduler import LoadIndex, schedule
+
+__all__ = ['Operation', 'OperationTracking', 'Production', 'Route',
+    'RouteOperation', 'Uom']
 
 STATES = {
     'readonly': Eval('state').in_(['running', 'done'])
     }
 
 
+@contextmanager
+def _savepoint(name):
+    "Roll back the queries of the block if it raises an exception"
+    transaction = Transaction()
+    cursor = transaction.connection.cursor()
+    cursor.execute('SAVEPOINT "%s"' % name)
+    try:
+        yield
+    except Exception:
+        cursor.execute('ROLLBACK TO SAVEPOINT "%s"' % name)
+        cursor.execute('RELEASE SAVEPOINT "%s"' % name)
+        # The cached records may contain rolled back values
+        transaction.counter += 1
+        for cache in transaction.cache.values():
+            cache.clear()
+        raise
+    else:
+        cursor.execute('RELEASE SAVEPOINT "%s"' % name)
+
+
 class Operation(sequence_ordered(), Workflow, ModelSQL, ModelView):
     'Operation'
     __name__ = 'production.operation'
@@ -34,9 +73,12 @@ class Operation(sequence_ordered(), Workflow, ModelSQL, ModelView):
             'work_center_category': Eval('work_center_category'),
             'work_center': Eval('work_center'),
             })
-    cost = fields.Function(fields.Numeric('Cost'), 'get_cost')
+    cost = fields.Function(fields.Numeric('Cost'), 'get_cost',
+        searcher='search_cost')
+    cost_cache = fields.Numeric('Cost Cache', readonly=True)
     total_quantity = fields.Function(fields.Float('Total Quantity'),
-        'get_total_quantity')
+        'get_total_quantity', searcher='search_total_quantity')
+    total_quantity_cache = fields.Float('Total Quantity Cache', readonly=True)
     operation_type = fields.Many2One('production.operation.type',
         'Operation Type', states=STATES, required=True)
     state = fields.Selection([
@@ -48,11 +90,33 @@ class Operation(sequence_ordered(), Workflow, ModelSQL, ModelView):
             ], 'State', readonly=True)
     company = fields.Function(fields.Many2One('company.company', 'Company'),
         'get_company', searcher='search_company')
+    planned_start_date = fields.DateTime('Planned Start Date', states=STATES)
+    planned_end_date = fields.DateTime('Planned End Date', states=STATES)
 
     @classmethod
     def __setup__(cls):
         super(Operation, cls).__setup__()
         cls._invalid_production_states_on_create = ['done']
+        cls._load_fields = {'state', 'work_center', 'work_center_category',
+            'route_operation', 'planned_start_date', 'cost_cache',
+            'total_quantity_cache'}
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                Index(t,
+                    (t.work_center, Index.Range()),
+                    (t.operation_type, Index.Range())),
+                Index(t,
+                    (t.production, Index.Range()),
+                    (t.state, Index.Equality(cardinality='low'))),
+                Index(t,
+                    (t.production, Index.Range()),
+                    (t.sequence, Index.Range()),
+                    (t.id, Index.Range())),
+                Index(
+                    t,
+                    (t.state, Index.Equality(cardinality='low')),
+                    where=t.state.in_(['planned', 'waiting', 'running'])),
+                })
         cls._transitions |= set((
                 ('planned', 'cancelled'),
                 ('planned', 'waiting'),
@@ -82,6 +146,8 @@ class Operation(sequence_ordered(), Workflow, ModelSQL, ModelView):
     def __register__(cls, module_name):
         cursor = Transaction().connection.cursor()
         sql_table = cls.__table__()
+        table_h = cls.__table_handler__(module_name)
+        cache_exist = table_h.column_exist('cost_cache')
 
         super(Operation, cls).__register__(module_name)
 
@@ -90,6 +156,18 @@ class Operation(sequence_ordered(), Workflow, ModelSQL, ModelView):
                 [sql_table.state], ['cancelled'],
                 where=sql_table.state == 'cancel'))
 
+        # Migration from 7.6: fill stored cost and total quantity
+        if not cache_exist:
+            cursor.execute(*sql_table.select(sql_table.id,
+                    where=sql_table.state != 'cancelled',
+                    order_by=sql_table.id))
+            for sub_ids in grouped_slice([i for i, in cursor]):
+                operations = cls.browse(list(sub_ids))
+                costs = cls._get_cost(operations)
+                totals = cls._get_total_quantity(operations)
+                cls._set_cache(
+                    [(o.id, costs[o.id], totals[o.id]) for o in operations])
+
     @staticmethod
     def default_state():
         return 'planned'
@@ -117,28 +195,40 @@ class Operation(sequence_ordered(), Workflow, ModelSQL, ModelView):
             ]
 
     @classmethod
+    @instrument('production.operation.create')
     def create(cls, vlist):
         pool = Pool()
         Production = pool.get('production')
+        WorkCenterLoad = pool.get('production.work_center.load')
         Warning = pool.get('res.user.warning')
-        vlist = [x.copy() for x in vlist]
-        productions = []
-        for value in vlist:
-            productions.append(value['production'])
-
-        invalid_productions = Production.search([
-                ('id', 'in', productions),
-                ('state', 'in', ['done']),
-                ], limit=1)
-
-        if invalid_productions:
-            production, = invalid_productions
-            key = 'invalid_production_state_%s' % production.id
-            if Warning.check(key):
-                raise UserWarning(key, gettext(
-                    'production_operation.invalid_production_state',
-                    production=production.rec_name))
-        return super(Operation, cls).create(vlist)
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = Production.__table__()
+
+        # Productions created in this transaction can not be in an invalid
+        # state yet
+        created = set(transaction.create_records['production'])
+        productions = {v.get('production') for v in vlist} - created
+        productions.discard(None)
+
+        invalid_states = cls._invalid_production_states_on_create
+        for sub_ids in grouped_slice(productions):
+            cursor.execute(*table.select(table.id,
+                    where=reduce_ids(table.id, sub_ids)
+                    & table.state.in_(invalid_states),
+                    limit=1))
+            row = cursor.fetchone()
+            if row:
+                production = Production(row[0])
+                key = 'invalid_production_state_%s' % production.id
+                if Warning.check(key):
+                    raise UserWarning(key, gettext(
+                        'production_operation.invalid_production_state',
+                        production=production.rec_name))
+                break
+        operations = super(Operation, cls).create(vlist)
+        WorkCenterLoad.update_loads({}, WorkCenterLoad.get_loads(operations))
+        return operations
 
     @classmethod
     def copy(cls, operations, default=None):
@@ -148,24 +238,482 @@ class Operation(sequence_ordered(), Workflow, ModelSQL, ModelView):
             default = default.copy()
         default.setdefault('state', 'planned')
         default.setdefault('lines', [])
+        default.setdefault('cost_cache', None)
+        default.setdefault('total_quantity_cache', None)
         return super(Operation, cls).copy(operations, default)
 
-    def get_cost(self, name):
-        cost = Decimal(0)
-        for line in self.lines:
-            cost += line.cost
-        return cost
+    @classmethod
+    def write(cls, *args):
+        WorkCenterLoad = Pool().get('production.work_center.load')
+        actions = iter(args)
+        to_store = []
+        to_load = []
+        for operations, values in zip(actions, actions):
+            if {'work_center', 'work_center_category'} & values.keys():
+                to_store.extend(operations)
+            if cls._load_fields & values.keys():
+                to_load.extend(operations)
+        removed = WorkCenterLoad.get_loads(to_load)
+        super(Operation, cls).write(*args)
+        if to_load:
+            to_load = cls.browse([o.id for o in to_load])
+            WorkCenterLoad.update_loads(
+                removed, WorkCenterLoad.get_loads(to_load))
+        if to_store:
+            cls.store_cache(to_store)
 
-    def get_total_quantity(self, name):
-        Uom = Pool().get('product.uom')
+    @classmethod
+    def delete(cls, operations):
+        WorkCenterLoad = Pool().get('production.work_center.load')
+        removed = WorkCenterLoad.get_loads(operations)
+        super(Operation, cls).delete(operations)
+        WorkCenterLoad.update_loads(removed, {})
+
+    def get_load_key(self):
+        "Return the key (work center, date, state) of the work center load"
+        date = (self.planned_start_date.date()
+            if self.planned_start_date else None)
+        return (self.work_center.id if self.work_center else None, date,
+            self.state)
+
+    @classmethod
+    def _get_tracking_quantities(cls, operations):
+        """Return the tracked quantities of the operations
+
+        The result is a dictionary with the operation id as key and a list of
+        tuples (uom, quantity, work center uom, work center cost price,
+        category uom) with one tuple per tracking line so the quantities are
+        rounded per line like OperationTracking.get_cost.
+        """
+        pool = Pool()
+        Tracking = pool.get('production.operation.tracking')
+        WorkCenter = pool.get('production.work_center')
+        WorkCenterCategory = pool.get('production.work_center.category')
+        cursor = Transaction().connection.cursor()
+        operation = cls.__table__()
+        tracking = Tracking.__table__()
+        work_center = WorkCenter.__table__()
+        category = WorkCenterCategory.__table__()
+
+        columns = [
+            operation.id, tracking.uom, operation.work_center,
+            work_center.uom, work_center.cost_price,
+            category.uom, category.cost_price,
+            ]
+        query = (tracking
+            .join(operation, condition=tracking.operation == operation.id)
+            .join(work_center, 'LEFT',
+                condition=operation.work_center == work_center.id)
+            .join(category, 'LEFT',
+                condition=operation.work_center_category == category.id))
+
+        quantities = defaultdict(list)
+        for sub_ids in grouped_slice(list(map(int, operations))):
+            cursor.execute(*query.select(*columns, tracking.quantity,
+                    where=reduce_ids(operation.id, sub_ids)))
+            for (operation_id, uom, work_center_id,
+                    work_center_uom, work_center_cost_price,
+                    category_uom, category_cost_price, quantity) in cursor:
+                # Same fallback as OperationTracking.get_cost
+                if not work_center_id:
+                    work_center_uom = category_uom
+                    work_center_cost_price = category_cost_price
+                quantities[operation_id].append((uom, quantity,
+                        work_center_uom, work_center_cost_price,
+                        category_uom))
+        return quantities
+
+    @classmethod
+    @instrument('production.operation.get_cost')
+    def get_cost(cls, operations, name):
+        costs = {}
+        to_compute = []
+        for operation in operations:
+            if operation.cost_cache is not None:
+                costs[operation.id] = operation.cost_cache
+            else:
+                to_compute.append(operation)
+        costs.update(cls._get_cost(to_compute))
+        return costs
+
+    @classmethod
+    def _get_cost(cls, operations):
+        pool = Pool()
+        Uom = pool.get('product.uom')
+
+        costs = dict.fromkeys(map(int, operations), Decimal(0))
+        quantities = cls._get_tracking_quantities(operations)
+        uoms = {u.id: u for u in Uom.browse(list({
+                        u for lines in quantities.values()
+                        for uom, _, work_center_uom, _, _ in lines
+                        for u in (uom, work_center_uom) if u}))}
+        for operation_id, lines in quantities.items():
+            for uom, quantity, work_center_uom, cost_price, _ in lines:
+                if not quantity or not work_center_uom or cost_price is None:
+                    continue
+                quantity = Uom.compute_qty_cached(uoms[uom], quantity,
+                    uoms[work_center_uom])
+                costs[operation_id] += Decimal(str(quantity)) * cost_price
+        return costs
 
-        total = 0.
-        for line in self.lines:
-            if not line.uom or not line.quantity:
+    @classmethod
+    @instrument('production.operation.get_total_quantity')
+    def get_total_quantity(cls, operations, name):
+        totals = {}
+        to_compute = []
+        for operation in operations:
+            if operation.total_quantity_cache is not None:
+                totals[operation.id] = operation.total_quantity_cache
+            else:
+                to_compute.append(operation)
+        totals.update(cls._get_total_quantity(to_compute))
+        return totals
+
+    @classmethod
+    def _get_total_quantity(cls, operations):
+        pool = Pool()
+        Uom = pool.get('product.uom')
+
+        totals = dict.fromkeys(map(int, operations), 0.)
+        quantities = cls._get_tracking_quantities(operations)
+        uoms = {u.id: u for u in Uom.browse(list({
+                        u for lines in quantities.values()
+                        for uom, _, _, _, category_uom in lines
+                        for u in (uom, category_uom) if u}))}
+        for operation_id, lines in quantities.items():
+            for uom, quantity, _, _, category_uom in lines:
+                if not uom or not quantity:
+                    continue
+                totals[operation_id] += Uom.compute_qty_cached(
+                    uoms[uom], quantity, uoms[category_uom])
+        return totals
+
+    @classmethod
+    def _search_cache(cls, column, clause):
+        "Search on the stored column with no value as 0"
+        table = cls.__table__()
+        _, operator, value = clause
+        Operator = fields.SQL_OPERATORS[operator]
+        field = cls._fields[column]
+        where = Operator(Coalesce(getattr(table, column), 0),
+            field._domain_value(operator, value))
+        return [('id', 'in', table.select(table.id, where=where))]
+
+    @classmethod
+    def search_cost(cls, name, clause):
+        return cls._search_cache('cost_cache', clause)
+
+    @classmethod
+    def search_total_quantity(cls, name, clause):
+        return cls._search_cache('total_quantity_cache', clause)
+
+    @staticmethod
+    def order_cost(tables):
+        table, _ = tables[None]
+        return [Coalesce(table.cost_cache, 0)]
+
+    @staticmethod
+    def order_total_quantity(tables):
+        table, _ = tables[None]
+        return [Coalesce(table.total_quantity_cache, 0)]
+
+    @classmethod
+    @without_check_access
+    def store_cache(cls, operations):
+        '''
+        Store the cost and total quantity computed from the tracking lines
+
+        The values are maintained by the tracking lines, the work centers and
+        the purchases so the access of the user is not checked.
+        '''
+        WorkCenterLoad = Pool().get('production.work_center.load')
+        operations = list(operations)
+        costs = cls._get_cost(operations)
+        totals = cls._get_total_quantity(operations)
+        to_update = [o for o in operations
+            if (costs[o.id], totals[o.id]) != (
+                o.cost_cache, o.total_quantity_cache)]
+        if not to_update:
+            return
+        removed = WorkCenterLoad.get_loads(to_update)
+        cls._set_cache([(o.id, costs[o.id], totals[o.id]) for o in to_update])
+        to_update = cls.browse([o.id for o in to_update])
+        WorkCenterLoad.update_loads(
+            removed, WorkCenterLoad.get_loads(to_update))
+
+    @classmethod
+    def _set_cache(cls, values):
+        '''
+        Update the stored cost and total quantity from the list of tuples
+        (id, cost, total quantity) with one query per slice
+        '''
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+        cost_field = cls._fields['cost_cache']
+        total_field = cls._fields['total_quantity_cache']
+
+        for sub_values in grouped_slice(values):
+            rows = Values([[id_, cost_field.sql_format(cost),
+                        total_field.sql_format(total)]
+                    for id_, cost, total in sub_values])
+            cursor.execute(*table.update(
+                    [table.cost_cache, table.total_quantity_cache,
+                        table.write_uid, table.write_date],
+                    [cost_field.sql_cast(rows.column2),
+                        total_field.sql_cast(rows.column3),
+                        transaction.user, CurrentTimestamp()],
+                    from_=[rows],
+                    where=table.id == rows.column1))
+
+        # Like ModelStorage._before_write
+        transaction.counter += 1
+        for cache in transaction.cache.values():
+            if cls.__name__ in cache:
+                cache_cls = cache[cls.__name__]
+                for id_, _, _ in values:
+                    cache_cls.pop(id_, None)
+
+    @classmethod
+    def get_planned_hours(cls, operations):
+        '''
+        Return the hours planned for the operations by their route operation
+        and the quantity of their production.
+        '''
+        pool = Pool()
+        Uom = pool.get('product.uom')
+        ModelData = pool.get('ir.model.data')
+        hour = Uom(ModelData.get_id('product', 'uom_hour'))
+
+        hours = {}
+        for operation in operations:
+            route_operation = operation.route_operation
+            if not route_operation or not route_operation.time:
+                hours[operation.id] = 0.
                 continue
-            total += Uom.compute_qty(line.uom, line.quantity,
-                self.work_center_category.uom)
-        return total
+            time = Uom.compute_qty(route_operation.time_uom,
+                route_operation.time, hour, round=False)
+            production = operation.production
+            if (route_operation.calculation == 'standard'
+                    and route_operation.quantity):
+                quantity = Uom.compute_qty(production.unit,
+                    production.quantity or 0, route_operation.quantity_uom,
+                    round=False)
+                time *= quantity / route_operation.quantity
+            hours[operation.id] = time
+        return hours
+
+    @classmethod
+    def get_queued_hours(cls, operations):
+        '''
+        Return the hours that remain to do on the operations: the planned
+        hours minus the hours already tracked.
+        '''
+        pool = Pool()
+        Uom = pool.get('product.uom')
+        ModelData = pool.get('ir.model.data')
+        hour = Uom(ModelData.get_id('product', 'uom_hour'))
+
+        planned = cls.get_planned_hours(operations)
+        totals = cls.get_total_quantity(operations, 'total_quantity')
+        hours = {}
+        for operation in operations:
+            done = Uom.compute_qty(operation.work_center_category.uom,
+                totals[operation.id], hour, round=False)
+            hours[operation.id] = max(planned[operation.id] - done, 0)
+        return hours
+
+    @classmethod
+    def dispatch(cls, operations=None):
+        '''
+        Assign the operations without work center to the least loaded work
+        center of their category.
+        By default all the planned and waiting operations without work center
+        are dispatched.
+        '''
+        pool = Pool()
+        WorkCenter = pool.get('production.work_center')
+
+        if operations is None:
+            operations = cls.search([
+                    ('work_center', '=', None),
+                    ('state', 'in', ['planned', 'waiting']),
+                    ], order=[('production', 'ASC'), ('sequence', 'ASC'),
+                    ('id', 'ASC')])
+        operations = [o for o in operations if not o.work_center]
+        if not operations:
+            return
+        categories = list({o.work_center_category.id for o in operations})
+
+        work_centers = defaultdict(list)
+        for work_center in WorkCenter.search([
+                    ('category', 'in', categories),
+                    ]):
+            work_centers[work_center.category.id].append(work_center.id)
+
+        loads = defaultdict(float)
+        queued = cls.search([
+                ('work_center', '!=', None),
+                ('work_center_category', 'in', categories),
+                ('state', 'in', ['planned', 'waiting', 'running']),
+                ])
+        for sub_operations in grouped_slice(queued):
+            sub_operations = list(sub_operations)
+            hours = cls.get_queued_hours(sub_operations)
+            for operation in sub_operations:
+                loads[operation.work_center.id] += hours[operation.id]
+
+        index = LoadIndex(work_centers, loads)
+        assignments = defaultdict(list)
+        hours = cls.get_queued_hours(operations)
+        for operation in operations:
+            work_center = index.assign(
+                operation.work_center_category.id, hours[operation.id])
+            if work_center:
+                assignments[work_center].append(operation)
+
+        to_write = []
+        for work_center, operations in assignments.items():
+            to_write.extend((operations, {'work_center': work_center}))
+        if to_write:
+            cls.write(*to_write)
+
+    @classmethod
+    def schedule(cls, operations=None, start=None):
+        '''
+        Set the planned start and end dates of the operations on the capacity
+        of their work center following the sequence inside each production.
+        By default all the planned and waiting operations are scheduled from
+        now.
+        '''
+        if operations is None:
+            operations = cls.search([
+                    ('state', 'in', ['planned', 'waiting']),
+                    ], order=[('production', 'ASC'), ('sequence', 'ASC'),
+                    ('id', 'ASC')])
+        else:
+            operations = sorted(operations,
+                key=lambda o: (o.production.id, o.sequence or 0, o.id))
+        if start is None:
+            start = datetime.datetime.now().replace(second=0, microsecond=0)
+
+        chains = defaultdict(list)
+        chain_starts = {}
+        hours = cls.get_planned_hours(operations)
+        for operation in operations:
+            production = operation.production
+            work_center = operation.work_center
+            chains[production.id].append((operation.id,
+                    work_center.id if work_center else None,
+                    datetime.timedelta(hours=hours[operation.id])))
+            if production.planned_start_date:
+                chain_starts[production.id] = datetime.datetime.combine(
+                    production.planned_start_date, datetime.time())
+        dates = schedule(chains, start, chain_starts=chain_starts,
+            resource_starts=cls._get_work_center_starts(operations))
+
+        for sub_operations in grouped_slice(operations):
+            # Group the operations by dates to update them with one query
+            to_update = defaultdict(list)
+            for operation in sub_operations:
+                to_update[dates[operation.id]].append(operation)
+            to_write = []
+            for (start_date, end_date), records in to_update.items():
+                to_write.extend((records, {
+                            'planned_start_date': start_date,
+                            'planned_end_date': end_date,
+                            }))
+            cls.write(*to_write)
+
+    @classmethod
+    def _get_work_center_starts(cls, operations):
+        '''
+        Return the latest planned end date per work center of the operations
+        already scheduled or running which are not in operations.
+        '''
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        where = (table.state.in_(['planned', 'waiting', 'running'])
+            & (table.work_center != Null)
+            & (table.planned_end_date != Null))
+        for sub_ids in grouped_slice(list(map(int, operations))):
+            where &= ~reduce_ids(table.id, sub_ids)
+        cursor.execute(*table.select(
+                table.work_center, Max(table.planned_end_date),
+                where=where,
+                group_by=table.work_center))
+        starts = {}
+        for work_center, date in cursor:
+            # SQLite does not convert to datetime
+            if isinstance(date, str):
+                date = datetime.datetime.fromisoformat(date)
+            starts[work_center] = date
+        return starts
+
+    @classmethod
+    def export_costing(cls, domain=None, format='csv', size=None):
+        '''
+        Yield the costing data of the operations matching the domain.
+
+        The operations are read by chunks of size ordered by id, so the
+        memory used does not depend on the number of operations. Each chunk
+        is yielded as CSV or JSON lines (format 'jsonl') text.
+        '''
+        if format not in {'csv', 'jsonl'}:
+            raise ValueError("Unknown format %s" % format)
+        if domain is None:
+            domain = []
+        if size is None:
+            size = Transaction().database.IN_MAX
+        header = ['production', 'operation_type', 'work_center',
+            'total_quantity', 'cost', 'state']
+
+        if format == 'csv':
+            buffer = io.StringIO()
+            csv.writer(buffer).writerow(header)
+            yield buffer.getvalue()
+
+        last_id = 0
+        while True:
+            operations = cls.search([
+                    domain,
+                    ('id', '>', last_id),
+                    ], order=[('id', 'ASC')], limit=size)
+            if not operations:
+                break
+            costs = cls.get_cost(operations, 'cost')
+            totals = cls.get_total_quantity(operations, 'total_quantity')
+
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            for operation in operations:
+                row = [
+                    operation.production.rec_name,
+                    operation.operation_type.rec_name,
+                    (operation.work_center.rec_name
+                        if operation.work_center else ''),
+                    totals[operation.id],
+                    str(costs[operation.id]),
+                    operation.state,
+                    ]
+                if format == 'csv':
+                    writer.writerow(row)
+                else:
+                    buffer.write(json.dumps(dict(zip(header, row))) + '\n')
+            yield buffer.getvalue()
+            last_id = operations[-1].id
+
+    @classmethod
+    @without_check_access
+    def update_cost_cache(cls, domain=None):
+        "Recompute the stored cost and total quantity of the operations"
+        operations = cls.search([
+                ('state', '!=', 'cancelled'),
+                domain or [],
+                ], order=[('id', 'ASC')])
+        for sub_operations in grouped_slice(operations):
+            cls.store_cache(sub_operations)
 
     @classmethod
     @ModelView.button
@@ -174,6 +722,7 @@ class Operation(sequence_ordered(), Workflow, ModelSQL, ModelView):
         pass
 
     @classmethod
+    @instrument('production.operation.wait')
     @ModelView.button
     @Workflow.transition('waiting')
     def wait(cls, operations):
@@ -186,25 +735,34 @@ class Operation(sequence_ordered(), Workflow, ModelSQL, ModelView):
         pass
 
     @classmethod
+    @instrument('production.operation.done')
     def done(cls, operations):
         pool = Pool()
         Production = pool.get('production')
         Config = pool.get('production.configuration')
-        config = Config(1)
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        config = Config.get_operation_configuration()
 
         productions = set([o.production for o in operations])
         cls.write(operations, {'state': 'done'})
-        to_done = []
-        for production in productions:
-            to_do = True
-            for operation in production.operations:
-                if operation.state != 'done':
-                    to_do = False
-                    break
-            if to_do:
-                to_done.append(production)
-        if config.allow_done_production:
-            Production.do(to_done)
+        cls.store_cache(operations)
+        pending = set()
+        for sub_ids in grouped_slice(list(map(int, productions))):
+            cursor.execute(*table.select(table.production,
+                    where=reduce_ids(table.production, sub_ids)
+                    & (table.state != 'done'),
+                    group_by=table.production))
+            pending.update(p for p, in cursor)
+        to_done = [p for p in productions if p.id not in pending]
+        if config['allow_done_production'] and to_done:
+            if config['done_production_queue']:
+                context = Transaction().context
+                with Transaction().set_context(
+                        queue_batch=context.get('queue_batch', True)):
+                    Production.__queue__.do(to_done)
+            else:
+                Production.do(to_done)
 
 
 class OperationTracking(ModelSQL, ModelView):
@@ -218,14 +776,158 @@ class OperationTracking(ModelSQL, ModelView):
             ('category', '=', Id('product', 'uom_cat_time')),
             ])
     quantity = fields.Float('Quantity', required=True, digits='uom')
+    date = fields.DateTime('Date')
     cost = fields.Function(fields.Numeric('Cost'), 'get_cost')
     company = fields.Function(fields.Many2One('company.company', 'Company'),
         'get_company', searcher='search_company')
 
+    @classmethod
+    def __setup__(cls):
+        super(OperationTracking, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(
+            Index(t,
+                (t.operation, Index.Range()),
+                (t.uom, Index.Range())))
+        cls.__rpc__.update({
+                'import_bookings': RPC(readonly=False),
+                })
+
     @staticmethod
     def default_quantity():
         return 0.0
 
+    @staticmethod
+    def default_date():
+        return datetime.datetime.now()
+
+    @classmethod
+    def create(cls, vlist):
+        Operation = Pool().get('production.operation')
+        lines = super(OperationTracking, cls).create(vlist)
+        Operation.store_cache({l.operation for l in lines})
+        return lines
+
+    @classmethod
+    def write(cls, *args):
+        Operation = Pool().get('production.operation')
+        actions = iter(args)
+        operations = set()
+        for lines, values in zip(actions, actions):
+            operations.update(l.operation for l in lines)
+            if values.get('operation'):
+                operations.add(Operation(values['operation']))
+        super(OperationTracking, cls).write(*args)
+        Operation.store_cache(operations)
+
+    @classmethod
+    def delete(cls, lines):
+        Operation = Pool().get('production.operation')
+        deleted = Transaction().delete_records['production.operation']
+        operations = {l.operation for l in lines
+            if l.operation.id not in deleted}
+        super(OperationTracking, cls).delete(lines)
+        Operation.store_cache(operations)
+
+    @classmethod
+    def import_bookings(cls, bookings):
+        '''
+        Create the tracking lines of the bookings of shop floor terminals.
+
+        bookings is a list of dictionaries with the keys operation (id), uom
+        (symbol), quantity and date. When uom is missing, the unit of the
+        work center is used and date is a datetime or an ISO formatted string.
+        The lines are created in one call, if it fails the bookings are split
+        to report the error on the failing rows.
+        Returns for each booking a dictionary with the id of the created line
+        or the error message.
+        '''
+        pool = Pool()
+        Operation = pool.get('production.operation')
+        Uom = pool.get('product.uom')
+        ModelData = pool.get('ir.model.data')
+
+        operations = Operation.search([
+                ('id', 'in', list({b['operation'] for b in bookings
+                            if b.get('operation')})),
+                ])
+        operations = {o.id: o for o in operations}
+        uoms = Uom.search([
+                ('category', '=', ModelData.get_id('product', 'uom_cat_time')),
+                ('symbol', 'in', list({b['uom'] for b in bookings
+                            if b.get('uom')})),
+                ])
+        uoms = {u.symbol: u for u in uoms}
+
+        def error(msg_id, booking, **variables):
+            return {
+                'error': gettext('production_operation.%s' % msg_id,
+                    operation=booking.get('operation'), **variables),
+                }
+
+        results = [None] * len(bookings)
+        to_create = []
+        for index, booking in enumerate(bookings):
+            operation = operations.get(booking.get('operation'))
+            if not operation:
+                results[index] = error('booking_operation_not_found', booking)
+                continue
+            if operation.state in {'cancelled', 'done'}:
+                results[index] = error('booking_operation_state', booking)
+                continue
+            if booking.get('uom'):
+                uom = uoms.get(booking['uom'])
+            else:
+                uom = (operation.work_center
+                    or operation.work_center_category).uom
+            if not uom:
+                results[index] = error('booking_invalid_uom', booking,
+                    uom=booking.get('uom'))
+                continue
+            quantity = booking.get('quantity')
+            if (isinstance(quantity, bool)
+                    or not isinstance(quantity, (int, float))):
+                results[index] = error('booking_invalid_quantity', booking,
+                    quantity=quantity)
+                continue
+            date = booking.get('date')
+            try:
+                if isinstance(date, str):
+                    date = datetime.datetime.fromisoformat(date)
+                elif not (date is None
+                        or isinstance(date, datetime.datetime)):
+                    raise ValueError
+            except ValueError:
+                results[index] = error('booking_invalid_date', booking,
+                    date=booking.get('date'))
+                continue
+            to_create.append((index, {
+                        'operation': operation.id,
+                        'uom': uom.id,
+                        'quantity': quantity,
+                        'date': date or datetime.datetime.now(),
+                        }))
+
+        def create(to_create):
+            "Create the lines or split them to report the failing rows"
+            try:
+                with _savepoint('import_bookings'):
+                    lines = cls.create([v for _, v in to_create])
+            except UserError as exception:
+                if len(to_create) == 1:
+                    (index, _), = to_create
+                    results[index] = {'error': exception.message}
+                else:
+                    middle = len(to_create) // 2
+                    create(to_create[:middle])
+                    create(to_create[middle:])
+            else:
+                for (index, _), line in zip(to_create, lines):
+                    results[index] = {'id': line.id}
+        if to_create:
+            create(to_create)
+        return results
+
     @staticmethod
     def default_uom():
         WorkCenter = Pool().get('production.work_center')
@@ -239,13 +941,14 @@ class OperationTracking(ModelSQL, ModelView):
             category = WorkCenterCategory(context['work_center_category'])
             return category.uom.id
 
+    @instrument('production.operation.tracking.get_cost')
     def get_cost(self, name):
         Uom = Pool().get('product.uom')
         work_center = (self.operation.work_center or
             self.operation.work_center_category)
         if not work_center:
             return Decimal(0)
-        quantity = Uom.compute_qty(self.uom, self.quantity,
+        quantity = Uom.compute_qty_cached(self.uom, self.quantity,
             work_center.uom)
         return Decimal(str(quantity)) * work_center.cost_price
 
@@ -277,56 +980,111 @@ class Production(metaclass=PoolMeta):
             ], states={
             'readonly': Eval('state') == 'done',
             })
+    _route_operations_cache = Cache('production.route.operations',
+        context=False)
 
-    def get_operation(self, route_operation):
+    @classmethod
+    def _get_operation_defaults(cls):
+        Operation = Pool().get('production.operation')
+        return Operation.default_get(
+            list(Operation._fields.keys()), with_rec_name=False)
+
+    @classmethod
+    def _get_route_operation_values(cls, route_operation):
         Operation = Pool().get('production.operation')
-        values = Operation.default_get(
-                    list(Operation._fields.keys()), with_rec_name=False)
-
-        operation = Operation(**values)
-        operation.sequence = route_operation.sequence
-        operation.work_center_category = route_operation.work_center_category
-        operation.work_center = route_operation.work_center
-        operation.operation_type = route_operation.operation_type
-        operation.route_operation = route_operation
+
+        def id_(record):
+            return record.id if record else None
+
+        values = {
+            'sequence': route_operation.sequence,
+            'work_center_category': id_(route_operation.work_center_category),
+            'work_center': id_(route_operation.work_center),
+            'operation_type': id_(route_operation.operation_type),
+            'route_operation': route_operation.id,
+            }
         if hasattr(Operation, 'subcontracted_product'):
-            operation.subcontracted_product = (
+            values['subcontracted_product'] = id_(
                 route_operation.subcontracted_product)
-        return operation
+        return values
+
+    @classmethod
+    def get_route_operations_values(cls, route):
+        "Return the list of operation values of the route"
+        values = cls._route_operations_cache.get(route.id)
+        if values is None:
+            values = [cls._get_route_operation_values(r)
+                for r in route.operations]
+            cls._route_operations_cache.set(route.id, values)
+        return [v.copy() for v in values]
+
+    def get_operation(self, route_operation, defaults=None, values=None):
+        """
+        Return the operation for the route operation.
+
+        values are the operation values of the route operation, as returned by
+        get_route_operations_values, computed when not given.
+        """
+        Operation = Pool().get('production.operation')
+        if defaults is None:
+            defaults = self._get_operation_defaults()
+        if values is None:
+            values = self._get_route_operation_values(route_operation)
+
+        operation_values = defaults.copy()
+        operation_values.update(values)
+        return Operation(**operation_values)
+
+    def _get_operations(self, defaults=None):
+        RouteOperation = Pool().get('production.route.operation')
+        if defaults is None:
+            defaults = self._get_operation_defaults()
+
+        operations = []
+        for values in self.get_route_operations_values(self.route):
+            route_operation = RouteOperation(values['route_operation'])
+            operations.append(
+                self.get_operation(route_operation, defaults, values))
+        return operations
 
     @fields.depends('route', 'operations')
     def on_change_route(self):
         self.operations = None
-        operations = []
         if self.route:
-            for route_operation in self.route.operations:
-                operation = self.get_operation(route_operation)
-                operations.append(operation)
-            self.operations = operations
+            self.operations = self._get_operations()
 
     @classmethod
+    @instrument('production.run')
     def run(cls, productions):
         pool = Pool()
         Operation = pool.get('production.operation')
+        cursor = Transaction().connection.cursor()
+        table = Operation.__table__()
 
         super(Production, cls).run(productions)
 
+        states = [f for f, t in Operation._transitions if t == 'waiting']
         operations = []
-        for production in productions:
-            operations.extend(production.operations)
+        for sub_ids in grouped_slice(list(map(int, productions))):
+            cursor.execute(*table.select(table.id,
+                    where=reduce_ids(table.production, sub_ids)
+                    & table.state.in_(states)))
+            operations.extend(i for i, in cursor)
 
         if operations:
-            Operation.wait(operations)
+            Operation.wait(Operation.browse(operations))
 
     @classmethod
+    @instrument('production.do')
     def do(cls, productions):
         pool = Pool()
         Config = pool.get('production.configuration')
         Operation = pool.get('production.operation')
+        Move = pool.get('stock.move')
         Warning = pool.get('res.user.warning')
 
-        config = Config(1)
-        if config.check_state_operation:
+        config = Config.get_operation_configuration()
+        if config['check_state_operation']:
             pending_operations = Operation.search([
                     ('production', 'in', [p.id for p in productions]),
                     ('state', 'not in', ['cancelled', 'done']),
@@ -334,7 +1092,7 @@ class Production(metaclass=PoolMeta):
             if pending_operations:
                 operation, = pending_operations
                 key ='pending_operation_%d' % operation.id
-                if config.check_state_operation == 'user_warning':
+                if config['check_state_operation'] == 'user_warning':
                     if Warning.check(key):
                         raise UserWarning(key,
                             gettext('production_operation.pending_operations',
@@ -346,8 +1104,11 @@ class Production(metaclass=PoolMeta):
                             production=operation.production.rec_name,
                             operation=operation.rec_name))
 
+        operations = [o for p in productions for o in p.operations]
+        costs = Operation.get_cost(operations, 'cost')
+        unit_prices = defaultdict(list)
         for production in productions:
-            operation_cost = sum(o.cost for o in production.operations)
+            operation_cost = sum(costs[o.id] for o in production.operations)
             if operation_cost == Decimal(0):
                 continue
             total_quantity = Decimal(str(sum(o.quantity for o in
@@ -355,11 +1116,17 @@ class Production(metaclass=PoolMeta):
             if total_quantity:
                 added_unit_price = round_price(operation_cost / total_quantity)
                 for output in production.outputs:
-                    output.unit_price += added_unit_price
-                    output.save()
+                    unit_prices[output.unit_price + added_unit_price].append(
+                        output)
+        to_write = []
+        for unit_price, outputs in unit_prices.items():
+            to_write.extend((outputs, {'unit_price': unit_price}))
+        if to_write:
+            Move.write(*to_write)
 
         super(Production, cls).do(productions)
 
+    @instrument('production.get_cost')
     def get_cost(self, name):
         cost = super(Production, self).get_cost(name)
         for operation in self.operations:
@@ -374,17 +1141,125 @@ class Production(metaclass=PoolMeta):
             warehouse, quantity, date, company, order_point)
         if product.boms and product.boms[0].route:
             production.route = product.boms[0].route
-            # TODO: it should be called next to set_moves()
-            production.set_operations()
+            # Operations are created in batch by generate_requests
+            if not Transaction().context.get('_defer_operations'):
+                production.set_operations()
         return production
 
-    def set_operations(self):
+    @classmethod
+    def generate_requests(cls, clean=True, warehouses=None):
+        "Inherited from stock_supply_production"
+        with Transaction().set_context(_defer_operations=True):
+            requests = super(Production, cls).generate_requests(
+                clean=clean, warehouses=warehouses)
+        cls.create_operations(requests or [])
+        return requests
+
+    def set_operations(self, defaults=None):
         if not self.route:
             return
 
-        self.operations = tuple()
-        for route_operation in self.route.operations:
-            self.operations += (self.get_operation(route_operation), )
+        self.operations = self._get_operations(defaults)
+
+    @classmethod
+    def create_operations(cls, productions):
+        "Create the route operations of the productions without operations"
+        Operation = Pool().get('production.operation')
+
+        defaults = cls._get_operation_defaults()
+        to_save = []
+        for production in productions:
+            if not production.route or production.operations:
+                continue
+            for operation in production._get_operations(defaults):
+                operation.production = production
+                to_save.append(operation)
+        Operation.save(to_save)
+
+
+class Route(metaclass=PoolMeta):
+    __name__ = 'production.route'
+
+    @classmethod
+    def create(cls, vlist):
+        Production = Pool().get('production')
+        Production._route_operations_cache.clear()
+        return super(Route, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        Production = Pool().get('production')
+        Production._route_operations_cache.clear()
+        super(Route, cls).write(*args)
+
+    @classmethod
+    def delete(cls, routes):
+        Production = Pool().get('production')
+        Production._route_operations_cache.clear()
+        super(Route, cls).delete(routes)
+
+
+class RouteOperation(metaclass=PoolMeta):
+    __name__ = 'production.route.operation'
+
+    @classmethod
+    def create(cls, vlist):
+        Production = Pool().get('production')
+        Production._route_operations_cache.clear()
+        return super(RouteOperation, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        Production = Pool().get('production')
+        Production._route_operations_cache.clear()
+        super(RouteOperation, cls).write(*args)
+
+    @classmethod
+    def delete(cls, operations):
+        Production = Pool().get('production')
+        Production._route_operations_cache.clear()
+        super(RouteOperation, cls).delete(operations)
+
+
+class Uom(metaclass=PoolMeta):
+    __name__ = 'product.uom'
+    _compute_factor_cache = Cache('product.uom.compute_factor',
+        context=False)
+
+    @classmethod
+    def write(cls, *args):
+        cls._compute_factor_cache.clear()
+        super(Uom, cls).write(*args)
+
+    @classmethod
+    def delete(cls, uoms):
+        cls._compute_factor_cache.clear()
+        super(Uom, cls).delete(uoms)
+
+    @classmethod
+    def compute_factor(cls, from_uom, to_uom):
+        "Return the factor to convert a quantity from from_uom to to_uom"
+        key = (from_uom.id, to_uom.id)
+        factor = cls._compute_factor_cache.get(key)
+        if factor is None:
+            factor = cls.compute_qty(from_uom, 1, to_uom, round=False)
+            cls._compute_factor_cache.set(key, factor)
+        return factor
+
+    @classmethod
+    def compute_qty_cached(cls, from_uom, qty, to_uom, round=True):
+        """
+        Convert quantity like compute_qty but using the cached conversion
+        factor between from_uom and to_uom.
+        """
+        if not qty or (from_uom is None and to_uom is None):
+            return qty
+        if from_uom is None or to_uom is None:
+            return cls.compute_qty(from_uom, qty, to_uom, round=round)
+        amount = qty * cls.compute_factor(from_uom, to_uom)
+        if round:
+            amount = to_uom.round(amount)
+        return amount
 
 
 class OperationSubcontrat(metaclass=PoolMeta):
@@ -409,7 +1284,12 @@ class OperationSubcontrat(metaclass=PoolMeta):
                 },
             })
 
-    def _get_purchase_request(self):
+    def _get_purchase_request_key(self):
+        "Return the key of the operations sharing the supplier lookup"
+        return (self.subcontracted_product, self.production.company,
+            self.production.planned_date)
+
+    def _get_purchase_request(self, purchase_date=None):
         pool = Pool()
         Request = pool.get('purchase.request')
 
@@ -420,11 +1300,11 @@ class OperationSubcontrat(metaclass=PoolMeta):
         # quantity = Uom.compute_qty(self.production.uom, quantity, uom)
         shortage_date = self.production.planned_date
         company = self.production.company
-        supplier_pattern = {}
-        supplier_pattern['company'] = company.id
-        supplier, purchase_date = Request.find_best_supplier(product,
-            shortage_date, **supplier_pattern)
-
+        if purchase_date is None:
+            supplier_pattern = {}
+            supplier_pattern['company'] = company.id
+            supplier, purchase_date = Request.find_best_supplier(product,
+                shortage_date, **supplier_pattern)
 
         location = self.production.warehouse
         request = Request(product=product,
@@ -439,79 +1319,194 @@ class OperationSubcontrat(metaclass=PoolMeta):
             )
         return request
 
+    @classmethod
+    def _get_purchase_requests(cls, operations):
+        '''
+        Return a dictionary with the operation as key and its purchase
+        request as value. The best supplier is searched once per key.
+        '''
+        pool = Pool()
+        Request = pool.get('purchase.request')
+
+        groups = defaultdict(list)
+        for operation in operations:
+            groups[operation._get_purchase_request_key()].append(operation)
+
+        requests = {}
+        for (product, company, date), group in groups.items():
+            _, purchase_date = Request.find_best_supplier(product, date,
+                company=company.id)
+            for operation in group:
+                requests[operation] = operation._get_purchase_request(
+                    purchase_date=purchase_date)
+        return requests
+
     @classmethod
     @ModelView.button
+    @instrument('production.operation.create_purchase_request')
     def create_purchase_request(cls, operations):
-        to_save = []
-        for operation in operations:
-            if not operation.subcontracted_product:
-                continue
-            request = operation._get_purchase_request()
-            operation.purchase_request = request
-            to_save.append(operation)
-        cls.save(to_save)
+        pool = Pool()
+        Request = pool.get('purchase.request')
 
-    def get_cost(self, name):
+        operations = [o for o in operations if o.subcontracted_product]
+        requests = cls._get_purchase_requests(operations)
+        Request.save(list(requests.values()))
+        to_write = []
+        for operation, request in requests.items():
+            to_write.extend(([operation], {'purchase_request': request.id}))
+        if to_write:
+            cls.write(*to_write)
+
+    @classmethod
+    def generate_purchase_requests(cls):
+        "Create the missing purchase requests of subcontracted operations"
+        operations = cls.search([
+                ('subcontracted_product', '!=', None),
+                ('purchase_request', '=', None),
+                ('state', 'in', ['planned', 'waiting']),
+                ])
+        cls.create_purchase_request(operations)
+
+    @classmethod
+    def _get_cost(cls, operations):
         pool = Pool()
         Uom = pool.get('product.uom')
-
-        if self.purchase_request and self.purchase_request.purchase_line:
-            cost = self.purchase_request.purchase_line.amount
-        elif self.subcontracted_product:
-            quantity = Uom.compute_qty(self.uom, self.total_quantity,
-                self.subcontracted_product.default_uom)
-            cost = (Decimal(str(quantity)) *
-                self.subcontracted_product.cost_price)
-        else:
-            cost = super().get_cost(name)
-        return cost
+        Request = pool.get('purchase.request')
+        Line = pool.get('purchase.line')
+        Product = pool.get('product.product')
+
+        # Read the related records in one list per model
+        requests = Request.browse(list({o.purchase_request.id
+                    for o in operations if o.purchase_request}))
+        amounts = {l.id: l.amount for l in Line.browse(list({
+                        r.purchase_line.id for r in requests
+                        if r.purchase_line}))}
+        lines = {r.id: r.purchase_line.id if r.purchase_line else None
+            for r in requests}
+        company_products = defaultdict(set)
+        for operation in operations:
+            if operation.subcontracted_product:
+                company_products[operation.company].add(
+                    operation.subcontracted_product.id)
+        products = {}
+        for company, product_ids in company_products.items():
+            with Transaction().set_context(
+                    company=company.id if company else None):
+                for product in Product.browse(list(product_ids)):
+                    products[company, product.id] = (
+                        product.default_uom, product.cost_price)
+
+        costs = {}
+        others = []
+        totals = cls._get_total_quantity(operations)
+        for operation in operations:
+            request = operation.purchase_request
+            line = lines.get(request.id) if request else None
+            product = operation.subcontracted_product
+            if line:
+                costs[operation.id] = amounts[line]
+            elif product:
+                uom, cost_price = products[operation.company, product.id]
+                category_uom = operation.work_center_category.uom
+                production = operation.production
+                if category_uom.category == uom.category:
+                    quantity = Uom.compute_qty_cached(
+                        category_uom, totals[operation.id], uom)
+                elif production.unit and production.unit.category == (
+                        uom.category):
+                    quantity = Uom.compute_qty_cached(
+                        production.unit, production.quantity or 0, uom)
+                else:
+                    # Like the purchase request
+                    quantity = production.quantity or 0
+                costs[operation.id] = (Decimal(str(quantity))
+                    * (cost_price or 0))
+            else:
+                others.append(operation)
+        costs.update(super()._get_cost(others))
+        return costs
 
     @classmethod
+    @instrument('production.operation.subcontract.wait')
     def wait(cls, operations):
         pool = Pool()
         Config = pool.get('production.configuration')
         Warning = pool.get('res.user.warning')
-        op_warn = []
-        config = Config(1)
-
-        if config.check_state_operation == 'user_warning':
-            op_warn = [op for op in operations if op.purchase_request]
-            if op_warn:
-                operation, = op_warn
-                key ='operation_%d' % operation.id
-                if Warning.check(key):
-                    raise UserWarning(key,
-                        gettext('production_operation.purchase_request_wait',
-                            production=operation.production.rec_name,
-                            operation=operation.rec_name))
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        config = Config.get_operation_configuration()
+
+        if config['check_state_operation'] == 'user_warning':
+            for sub_ids in grouped_slice(list(map(int, operations))):
+                cursor.execute(*table.select(table.id,
+                        where=reduce_ids(table.id, sub_ids)
+                        & (table.purchase_request != Null),
+                        limit=1))
+                row = cursor.fetchone()
+                if row:
+                    operation = cls(row[0])
+                    key = 'operation_%d' % operation.id
+                    if Warning.check(key):
+                        raise UserWarning(key,
+                            gettext(
+                                'production_operation.purchase_request_wait',
+                                production=operation.production.rec_name,
+                                operation=operation.rec_name))
+                    break
 
         super().wait(operations)
 
     @classmethod
+    @instrument('production.operation.subcontract.done')
     def done(cls, operations):
         pool = Pool()
+        Config = pool.get('production.configuration')
+        Request = pool.get('purchase.request')
+        Line = pool.get('purchase.line')
         Purchase = pool.get('purchase.purchase')
-        requests = set([o.purchase_request for o in operations if
-            o.purchase_request])
-        purchases = [r.purchase for r in requests if r.purchase]
-
-        for request in requests:
-            if request.purchase:
-                continue
-            raise UserError(
-                gettext('production_operation.purchase_missing',
-                    request=request.rec_name))
-
-        for purchase in purchases:
-            if purchase.state in ('processing', 'done'):
-                continue
-            raise UserError(
-                gettext('production_operation.purchase_pending',
-                    purchase=purchase.rec_name))
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        request = Request.__table__()
+        line = Line.__table__()
+        purchase = Purchase.__table__()
+
+        # Only the invoice of the purchases on shipment depends on the
+        # state of the operations, the others are already processed
+        purchase_ids = set()
+        query = table.join(request,
+            condition=table.purchase_request == request.id
+            ).join(line, 'LEFT',
+                condition=request.purchase_line == line.id
+            ).join(purchase, 'LEFT',
+                condition=line.purchase == purchase.id)
+        for sub_ids in grouped_slice(list(map(int, operations))):
+            cursor.execute(*query.select(
+                    request.id, purchase.id, purchase.state,
+                    purchase.invoice_method,
+                    where=reduce_ids(table.id, sub_ids)))
+            for request_id, purchase_id, state, invoice_method in cursor:
+                if not purchase_id:
+                    raise UserError(
+                        gettext('production_operation.purchase_missing',
+                            request=Request(request_id).rec_name))
+                if state not in ('processing', 'done'):
+                    raise UserError(
+                        gettext('production_operation.purchase_pending',
+                            purchase=Purchase(purchase_id).rec_name))
+                if state == 'processing' and invoice_method == 'shipment':
+                    purchase_ids.add(purchase_id)
 
         super().done(operations)
-        if purchases:
-            Purchase.process(purchases)
+        if purchase_ids:
+            purchases = Purchase.browse(sorted(purchase_ids))
+            config = Config.get_operation_configuration()
+            if config['process_purchase_queue']:
+                context = Transaction().context
+                with Transaction().set_context(
+                        queue_batch=context.get('queue_batch', True)):
+                    Purchase.__queue__.process(purchases)
+            else:
+                Purchase.process(purchases)
 
     @classmethod
     def copy(cls, operations, default=None):
@@ -580,6 +1575,34 @@ class PurchaseLine(metaclass=PoolMeta):
         default.setdefault('origin', None)
         return super().copy(lines, default=default)
 
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Operation = pool.get('production.operation')
+        actions = iter(args)
+        lines = []
+        for records, values in zip(actions, actions):
+            if {'quantity', 'unit', 'unit_price'} & values.keys():
+                lines.extend(records)
+        super().write(*args)
+        if lines:
+            Operation.update_cost_cache([
+                    ('purchase_request.purchase_line', 'in',
+                        [l.id for l in lines]),
+                    ])
+
+    @classmethod
+    def delete(cls, lines):
+        pool = Pool()
+        Operation = pool.get('production.operation')
+        operations = Operation.search([
+                ('purchase_request.purchase_line', 'in',
+                    [l.id for l in lines]),
+                ])
+        super().delete(lines)
+        if operations:
+            Operation.store_cache(Operation.browse([o.id for o in operations]))
+
 
 class PurchaseRequest(metaclass=PoolMeta):
     __name__ = 'purchase.request'
@@ -588,6 +1611,21 @@ class PurchaseRequest(metaclass=PoolMeta):
     def _get_origin(cls):
         return super()._get_origin()  | {'production.operation'}
 
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Operation = pool.get('production.operation')
+        actions = iter(args)
+        requests = []
+        for records, values in zip(actions, actions):
+            if 'purchase_line' in values:
+                requests.extend(records)
+        super().write(*args)
+        if requests:
+            Operation.update_cost_cache([
+                    ('purchase_request', 'in', [r.id for r in requests]),
+                    ])
+
 
 class CreatePurchase(metaclass=PoolMeta):
     __name__ = 'purchase.request.create_purchase'
@@ -0,0 +1,93 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import heapq
+import itertools
+from collections import defaultdict
+
+__all__ = ['schedule', 'LoadIndex']
+
+
+def schedule(chains, start, chain_starts=None, resource_starts=None):
+    '''
+    Schedule chains of tasks on resources of finite capacity.
+
+    chains is a dictionary with the chain key as key and the list of tasks
+    to execute in order as value. A task is a tuple (key, resource,
+    duration) where resource is None for tasks with infinite capacity.
+    A resource executes one task at a time and a task can not start before
+    the end of the previous task of its chain.
+    chain_starts and resource_starts are dictionaries with the earliest
+    start of chains and resources, start is used for the others.
+
+    Returns a dictionary with the task key as key and the tuple (start, end)
+    as value.
+
+    The tasks are dispatched in order of readiness using a priority queue,
+    so it runs in O(n log n) for n tasks.
+    '''
+    if chain_starts is None:
+        chain_starts = {}
+    if resource_starts is None:
+        resource_starts = {}
+    available = defaultdict(lambda: start, resource_starts)
+    counter = itertools.count()
+
+    queue = []
+    for key, tasks in chains.items():
+        if tasks:
+            ready = max(start, chain_starts.get(key, start))
+            queue.append((ready, next(counter), key, 0))
+    heapq.heapify(queue)
+
+    result = {}
+    while queue:
+        ready, _, key, index = heapq.heappop(queue)
+        task, resource, duration = chains[key][index]
+        if resource is not None:
+            begin = max(ready, available[resource])
+            end = available[resource] = begin + duration
+        else:
+            begin, end = ready, ready + duration
+        result[task] = (begin, end)
+        if index + 1 < len(chains[key]):
+            heapq.heappush(queue, (end, next(counter), key, index + 1))
+    return result
+
+
+class LoadIndex(object):
+    '''
+    Index of the load of resources grouped by category.
+
+    Each category keeps a heap of its resources ordered by load, so the least
+    loaded resource is found and updated in O(log n).
+    '''
+
+    def __init__(self, categories, loads=None):
+        '''
+        categories is a dictionary with the category as key and the list of
+        its resources as value. loads is a dictionary with the current load
+        of the resources.
+        '''
+        if loads is None:
+            loads = {}
+        self._heaps = {}
+        for category, resources in categories.items():
+            heap = [(loads.get(r, 0), r) for r in resources]
+            heapq.heapify(heap)
+            self._heaps[category] = heap
+
+    def assign(self, category, load):
+        '''
+        Add the load to the least loaded resource of the category and return
+        it or None if the category has no resource.
+        '''
+        heap = self._heaps.get(category)
+        if not heap:
+            return None
+        current, resource = heap[0]
+        heapq.heapreplace(heap, (current + load, resource))
+        return resource
+
+    def load(self, category):
+        "Return a dictionary with the load of the resources of the category"
+        return {r: l for l, r in self._heaps.get(category, [])}
@@ -0,0 +1,331 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+"""
+Benchmark the hot paths of production_operation on synthetic data.
+
+It uses the same database setup as the tests, for example:
+
+    DB_NAME=:memory: python -m \\
+        trytond.modules.production_operation.tests.benchmark \\
+        --productions 1000 --trackings 10000
+
+The default sizes are the reference dataset: 1000 routes, 100000
+productions and 1000000 tracking lines.
+"""
+import argparse
+import datetime as dt
+import random
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from decimal import Decimal
+
+from trytond.modules.company.tests.tools import create_company
+from trytond.pool import Pool
+from trytond.tests.test_tryton import DB_NAME, drop_db
+from trytond.tests.tools import activate_modules
+from trytond.tools import grouped_slice
+from trytond.transaction import Transaction
+
+from ..instrumentation import QueryCounter
+from ..scheduler import schedule
+
+
+class Benchmark(object):
+    "Accumulate the wall time, queries and records per step"
+
+    def __init__(self):
+        self.results = OrderedDict()
+
+    @contextmanager
+    def measure(self, name, records):
+        start = time.perf_counter()
+        with QueryCounter() as counter:
+            yield
+        duration = time.perf_counter() - start
+        total = self.results.setdefault(name, [0, 0., 0])
+        total[0] += records
+        total[1] += duration
+        total[2] += counter.count
+
+    def report(self):
+        print('%-40s %10s %10s %10s %12s' % (
+                'step', 'records', 'seconds', 'queries', 'records/s'))
+        for name, (records, duration, queries) in self.results.items():
+            print('%-40s %10d %10.3f %10d %12.1f' % (
+                    name, records, duration, queries,
+                    records / duration if duration else 0))
+
+
+def create_data(args):
+    pool = Pool()
+    ModelData = pool.get('ir.model.data')
+    Uom = pool.get('product.uom')
+    Location = pool.get('stock.location')
+    OperationType = pool.get('production.operation.type')
+    WorkCenterCategory = pool.get('production.work_center.category')
+    WorkCenter = pool.get('production.work_center')
+    Route = pool.get('production.route')
+    Template = pool.get('product.template')
+
+    hour = Uom(ModelData.get_id('product', 'uom_hour'))
+    unit = Uom(ModelData.get_id('product', 'uom_unit'))
+    warehouse, = Location.search([('code', '=', 'WH')])
+    production_location, = Location.search([('code', '=', 'PROD')])
+    Location.write([warehouse], {
+            'production_location': production_location.id,
+            })
+
+    types = OperationType.create([{
+                'name': 'Operation %d' % i,
+                } for i in range(args.operations)])
+    category, = WorkCenterCategory.create([{
+                'name': 'Category',
+                'uom': hour.id,
+                'cost_price': Decimal(25),
+                }])
+    work_centers = WorkCenter.create([{
+                'name': 'Work Center %d' % i,
+                'type': 'machine',
+                'category': category.id,
+                'uom': hour.id,
+                'cost_price': Decimal(25 + i % 10),
+                } for i in range(args.work_centers)])
+
+    routes = []
+    for sub_routes in grouped_slice(range(args.routes), args.batch):
+        routes.extend(Route.create([{
+                        'name': 'Route %d' % i,
+                        'uom': unit.id,
+                        'operations': [('create', [{
+                                        'sequence': j,
+                                        'operation_type': type_.id,
+                                        'work_center_category': category.id,
+                                        'work_center': random.choice(
+                                            work_centers).id,
+                                        'time': 1,
+                                        'quantity': 1,
+                                        'quantity_uom': unit.id,
+                                        } for j, type_ in enumerate(types)])],
+                        } for i in sub_routes]))
+        Transaction().commit()
+
+    product_template, service_template = Template.create([{
+                'name': 'Product',
+                'default_uom': unit.id,
+                'type': 'goods',
+                'producible': True,
+                'list_price': Decimal(30),
+                'products': [('create', [{}])],
+                }, {
+                'name': 'Subcontract',
+                'default_uom': unit.id,
+                'type': 'service',
+                'purchasable': True,
+                'purchase_uom': unit.id,
+                'list_price': Decimal(10),
+                'products': [('create', [{}])],
+                }])
+    product, = product_template.products
+    service, = service_template.products
+    Transaction().commit()
+    return {
+        'warehouse': warehouse,
+        'location': production_location,
+        'unit': unit,
+        'hour': hour,
+        'category': category,
+        'types': types,
+        'routes': routes,
+        'product': product,
+        'service': service,
+        }
+
+
+def create_productions(data, count, batch):
+    Production = Pool().get('production')
+    company = Transaction().context['company']
+    today = dt.date.today()
+    routes = data['routes']
+
+    productions = []
+    for sub_ids in grouped_slice(range(count), batch):
+        productions.extend(Production.create([{
+                        'company': company,
+                        'warehouse': data['warehouse'].id,
+                        'location': data['location'].id,
+                        'product': data['product'].id,
+                        'unit': data['unit'].id,
+                        'quantity': 1,
+                        'route': routes[i % len(routes)].id,
+                        'planned_date': today,
+                        } for i in sub_ids]))
+        Transaction().commit()
+    return productions
+
+
+def run(args):
+    pool = Pool()
+    Uom = pool.get('product.uom')
+    Configuration = pool.get('production.configuration')
+    Production = pool.get('production')
+    Operation = pool.get('production.operation')
+    OperationTracking = pool.get('production.operation.tracking')
+    transaction = Transaction()
+    cursor = transaction.connection.cursor()
+    benchmark = Benchmark()
+
+    data = create_data(args)
+    productions = create_productions(data, args.productions, args.batch)
+    subcontract_productions = create_productions(
+        data, args.subcontracted, args.batch)
+
+    for sub_productions in grouped_slice(
+            productions + subcontract_productions, args.batch):
+        sub_productions = Production.browse(list(sub_productions))
+        with benchmark.measure('route instantiation', len(sub_productions)):
+            Production.create_operations(sub_productions)
+        transaction.commit()
+
+    # Many operations for few productions in one call
+    creation_productions = create_productions(
+        data, args.creation_productions, args.batch)
+    vlist = [{
+            'production': creation_productions[
+                i % len(creation_productions)].id,
+            'work_center_category': data['category'].id,
+            'operation_type': data['types'][i % len(data['types'])].id,
+            } for i in range(args.creations)]
+    with benchmark.measure('operation creation', len(vlist)):
+        Operation.create(vlist)
+    transaction.commit()
+
+    operations = Operation.search([
+            ('production', 'in', [p.id for p in subcontract_productions]),
+            ])
+    Operation.write(operations, {
+            'subcontracted_product': data['service'].id,
+            })
+    transaction.commit()
+    for sub_operations in grouped_slice(operations, args.batch):
+        sub_operations = Operation.browse(list(sub_operations))
+        with benchmark.measure(
+                'subcontract purchase creation', len(sub_operations)):
+            Operation.create_purchase_request(sub_operations)
+        transaction.commit()
+
+    for sub_productions in grouped_slice(productions, args.batch):
+        sub_productions = Production.browse(list(sub_productions))
+        Production.wait(sub_productions)
+        Production.assign_try(sub_productions)
+        transaction.commit()
+        with benchmark.measure('production run', len(sub_productions)):
+            Production.run(sub_productions)
+        transaction.commit()
+
+    operations = Operation.search([
+            ('production', 'in', [p.id for p in productions]),
+            ], order=[('id', 'ASC')])
+    for sub_ids in grouped_slice(range(args.trackings), args.batch):
+        bookings = [{
+                'operation': operations[i % len(operations)].id,
+                'uom': 'min',
+                'quantity': float(random.randint(1, 120)),
+                } for i in sub_ids]
+        with benchmark.measure('tracking ingestion', len(bookings)):
+            OperationTracking.import_bookings(bookings)
+        transaction.commit()
+
+    for sub_operations in grouped_slice(operations, args.batch):
+        sub_operations = Operation.browse(list(sub_operations))
+        with benchmark.measure('operation cost read', len(sub_operations)):
+            Operation.read([o.id for o in sub_operations],
+                ['cost', 'total_quantity'])
+        sub_operations = Operation.browse([o.id for o in sub_operations])
+        with benchmark.measure(
+                'operation cost compute', len(sub_operations)):
+            Operation._get_cost(sub_operations)
+            Operation._get_total_quantity(sub_operations)
+    for sub_productions in grouped_slice(productions, args.batch):
+        sub_ids = [p.id for p in sub_productions]
+        with benchmark.measure('production cost read', len(sub_ids)):
+            Production.read(sub_ids, ['cost'])
+
+    tracking = OperationTracking.__table__()
+    cursor.execute(*tracking.select(tracking.uom, tracking.quantity))
+    lines = cursor.fetchall()
+    uoms = {u.id: u for u in Uom.browse(list({u for u, _ in lines}))}
+    hour = data['hour']
+    with benchmark.measure('uom compute_qty', len(lines)):
+        for uom, quantity in lines:
+            Uom.compute_qty(uoms[uom], quantity, hour)
+    with benchmark.measure('uom compute_qty_cached', len(lines)):
+        for uom, quantity in lines:
+            Uom.compute_qty_cached(uoms[uom], quantity, hour)
+
+    Configuration.write([Configuration(1)], {
+            'allow_done_production': False,
+            })
+    transaction.commit()
+    for sub_operations in grouped_slice(operations, args.batch):
+        sub_operations = Operation.browse(list(sub_operations))
+        Operation.run(sub_operations)
+        with benchmark.measure('operation done', len(sub_operations)):
+            Operation.done(sub_operations)
+        transaction.commit()
+    for sub_productions in grouped_slice(productions, args.batch):
+        sub_productions = Production.browse(list(sub_productions))
+        with benchmark.measure('production do', len(sub_productions)):
+            Production.do(sub_productions)
+        transaction.commit()
+
+    start = dt.datetime(2000, 1, 1)
+    work_centers = ['wc%d' % i for i in range(args.work_centers)]
+    chains = {
+        i: [(
+                (i, j), random.choice(work_centers),
+                dt.timedelta(minutes=random.randint(1, 120)))
+            for j in range(args.operations)]
+        for i in range(args.productions)}
+    with benchmark.measure('scheduler', args.productions * args.operations):
+        schedule(chains, start)
+
+    benchmark.report()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the production_operation hot paths")
+    parser.add_argument('--routes', type=int, default=1000)
+    parser.add_argument('--operations', type=int, default=3,
+        help="operations per route")
+    parser.add_argument('--work-centers', dest='work_centers', type=int,
+        default=20)
+    parser.add_argument('--productions', type=int, default=100000)
+    parser.add_argument('--subcontracted', type=int, default=1000,
+        help="productions with subcontracted operations")
+    parser.add_argument('--trackings', type=int, default=1000000)
+    parser.add_argument('--creations', type=int, default=10000,
+        help="operations created in one call")
+    parser.add_argument('--creation-productions',
+        dest='creation_productions', type=int, default=10,
+        help="productions of the operations created in one call")
+    parser.add_argument('--batch', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    drop_db()
+    config = activate_modules(['production_operation', 'purchase_request'])
+    company = create_company(config=config)
+    try:
+        with Transaction().start(DB_NAME, 1, context={
+                    'company': company.id,
+                    }):
+            run(args)
+    finally:
+        drop_db()
+
+
+if __name__ == '__main__':
+    main()
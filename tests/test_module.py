@@ -1,9 +1,23 @@
 
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
+import csv
+import datetime as dt
+import json
+from decimal import Decimal
 
-from trytond.modules.company.tests import CompanyTestMixin
-from trytond.tests.test_tryton import ModuleTestCase
+from trytond.exceptions import UserError
+from trytond.modules.company.tests import (
+    CompanyTestMixin, create_company, set_company)
+from trytond.pool import Pool
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.transaction import Transaction, check_access
+
+from .. import instrumentation
+from ..instrumentation import QueryCounter, instrument
+from ..scheduler import LoadIndex, schedule
+
+QUERY_SIZES = [1, 5, 20]
 
 
 class ProductionOperationTestCase(CompanyTestMixin, ModuleTestCase):
@@ -11,4 +25,1176 @@ class ProductionOperationTestCase(CompanyTestMixin, ModuleTestCase):
     module = 'production_operation'
     extras = ['purchase_request']
 
+    @with_transaction()
+    def test_export_costing_empty(self):
+        "Test export costing without operations"
+        pool = Pool()
+        Operation = pool.get('production.operation')
+
+        self.assertEqual(list(Operation.export_costing()), [
+                'production,operation_type,work_center,total_quantity,'
+                'cost,state\r\n'])
+        self.assertEqual(list(Operation.export_costing(format='jsonl')), [])
+
+    @with_transaction()
+    def test_uom_compute_qty_cached(self):
+        "Test compute quantity with cached factor"
+        pool = Pool()
+        Uom = pool.get('product.uom')
+        ModelData = pool.get('ir.model.data')
+        hour = Uom(ModelData.get_id('product', 'uom_hour'))
+        minute = Uom(ModelData.get_id('product', 'uom_minute'))
+
+        for qty in [0, 30, 90, 1.5]:
+            with self.subTest(qty=qty):
+                self.assertEqual(
+                    Uom.compute_qty_cached(minute, qty, hour),
+                    Uom.compute_qty(minute, qty, hour))
+                self.assertEqual(
+                    Uom.compute_qty_cached(hour, qty, minute),
+                    Uom.compute_qty(hour, qty, minute))
+
+        category = minute.category
+        unit, = Uom.create([{
+                    'name': "Test",
+                    'symbol': "T",
+                    'category': category.id,
+                    'factor': 2,
+                    'rate': 0.5,
+                    }])
+        self.assertEqual(Uom.compute_qty_cached(unit, 1, hour), 2)
+        Uom.write([unit], {'factor': 4, 'rate': 0.25})
+        unit = Uom(unit.id)
+        self.assertEqual(Uom.compute_qty_cached(unit, 1, hour), 4)
+
+    @with_transaction()
+    def test_operation_configuration_cache(self):
+        "Test operation configuration is cleared on write"
+        pool = Pool()
+        Configuration = pool.get('production.configuration')
+
+        config = Configuration.get_operation_configuration()
+        self.assertEqual(config['allow_done_production'], True)
+
+        Configuration.write([Configuration(1)], {
+                'allow_done_production': False,
+                })
+        config = Configuration.get_operation_configuration()
+        self.assertEqual(config['allow_done_production'], False)
+
+    @with_transaction()
+    def test_query_counter(self):
+        "Test query counter"
+        pool = Pool()
+        Operation = pool.get('production.operation')
+
+        Operation.search([])
+        with QueryCounter() as counter:
+            Operation.search([])
+        self.assertEqual(counter.count, 1)
+
+    def test_query_counter_cursor_context(self):
+        "Test counted cursor as context manager"
+        class Cursor(object):
+            entered = exited = False
+
+            def __enter__(self):
+                self.entered = True
+                return self
+
+            def __exit__(self, type, value, traceback):
+                self.exited = True
+
+            def execute(self, query):
+                pass
+
+        cursor = Cursor()
+        counter = QueryCounter()
+        with instrumentation._CountingCursor(cursor, counter) as counted:
+            counted.execute('SELECT 1')
+
+        self.assertTrue(cursor.entered)
+        self.assertTrue(cursor.exited)
+        self.assertEqual(counter.count, 1)
+
+    @with_transaction()
+    def test_instrument(self):
+        "Test instrumentation statistics"
+        pool = Pool()
+        Operation = pool.get('production.operation')
+
+        @instrument('test')
+        def search(cls, domain):
+            return cls.search(domain)
+
+        Operation.search([])
+        enabled = instrumentation.ENABLED
+        instrumentation.ENABLED = True
+        try:
+            for _ in range(3):
+                search(Operation, [])
+        finally:
+            instrumentation.ENABLED = enabled
+        stats = instrumentation.stats()
+        instrumentation.reset()
+
+        self.assertEqual(stats['test']['calls'], 3)
+        self.assertEqual(stats['test']['queries_p95'], 1)
+        self.assertEqual(stats['test']['records_p50'], 0)
+
+    def test_schedule(self):
+        "Test schedule on finite capacity"
+        start = dt.datetime(2020, 1, 1)
+        hour = dt.timedelta(hours=1)
+        chains = {
+            'p1': [('p1-1', 'wc1', 2 * hour), ('p1-2', 'wc2', hour)],
+            'p2': [('p2-1', 'wc1', hour), ('p2-2', None, hour)],
+            }
+
+        dates = schedule(chains, start)
+
+        self.assertEqual(dates, {
+                'p1-1': (start, start + 2 * hour),
+                'p2-1': (start + 2 * hour, start + 3 * hour),
+                'p1-2': (start + 2 * hour, start + 3 * hour),
+                'p2-2': (start + 3 * hour, start + 4 * hour),
+                })
+
+    def test_schedule_chain_start(self):
+        "Test schedule with chain start"
+        start = dt.datetime(2020, 1, 1)
+        hour = dt.timedelta(hours=1)
+        chains = {
+            'p1': [('p1-1', 'wc1', hour)],
+            'p2': [('p2-1', 'wc1', hour)],
+            }
+
+        dates = schedule(chains, start, chain_starts={'p1': start + hour})
+
+        self.assertEqual(dates, {
+                'p2-1': (start, start + hour),
+                'p1-1': (start + hour, start + 2 * hour),
+                })
+
+    def test_load_index(self):
+        "Test load index assigns to least loaded resource"
+        index = LoadIndex({
+                'cat1': ['wc1', 'wc2'],
+                'cat2': [],
+                }, {'wc1': 3})
+
+        self.assertEqual(index.assign('cat1', 2), 'wc2')
+        self.assertEqual(index.assign('cat1', 2), 'wc2')
+        self.assertEqual(index.assign('cat1', 1), 'wc1')
+        self.assertEqual(index.load('cat1'), {'wc1': 4, 'wc2': 4})
+        self.assertEqual(index.assign('cat2', 1), None)
+        self.assertEqual(index.assign('cat3', 1), None)
+
+    def _create_route(self):
+        "Create the route and product of the production scenario"
+        pool = Pool()
+        ModelData = pool.get('ir.model.data')
+        Uom = pool.get('product.uom')
+        Location = pool.get('stock.location')
+        OperationType = pool.get('production.operation.type')
+        WorkCenterCategory = pool.get('production.work_center.category')
+        WorkCenter = pool.get('production.work_center')
+        Route = pool.get('production.route')
+        Template = pool.get('product.template')
+
+        hour = Uom(ModelData.get_id('product', 'uom_hour'))
+        unit = Uom(ModelData.get_id('product', 'uom_unit'))
+        warehouse, = Location.search([('code', '=', 'WH')])
+        production_location, = Location.search([('code', '=', 'PROD')])
+        Location.write([warehouse], {
+                'production_location': production_location.id,
+                })
+        assembly, cleaning = OperationType.create([{
+                    'name': 'Assembly',
+                    }, {
+                    'name': 'Cleaning',
+                    }])
+        category, = WorkCenterCategory.create([{
+                    'name': 'Default Category',
+                    'uom': hour.id,
+                    'cost_price': Decimal(25),
+                    }])
+        work_center1, work_center2 = WorkCenter.create([{
+                    'name': 'Assembler Machine',
+                    'type': 'machine',
+                    'category': category.id,
+                    'uom': hour.id,
+                    'cost_price': Decimal(25),
+                    }, {
+                    'name': 'Cleaner Machine',
+                    'type': 'machine',
+                    'category': category.id,
+                    'uom': hour.id,
+                    'cost_price': Decimal(50),
+                    }])
+        route, = Route.create([{
+                    'name': 'default route',
+                    'uom': unit.id,
+                    'operations': [('create', [{
+                                    'sequence': 1,
+                                    'operation_type': assembly.id,
+                                    'work_center_category': category.id,
+                                    'work_center': work_center1.id,
+                                    'time': 1,
+                                    'quantity': 3,
+                                    'quantity_uom': unit.id,
+                                    }, {
+                                    'sequence': 2,
+                                    'operation_type': cleaning.id,
+                                    'calculation': 'fixed',
+                                    'work_center_category': category.id,
+                                    'work_center': work_center2.id,
+                                    'time': 1,
+                                    }])],
+                    }])
+        template, = Template.create([{
+                    'name': 'product',
+                    'default_uom': unit.id,
+                    'type': 'goods',
+                    'producible': True,
+                    'list_price': Decimal(30),
+                    'products': [('create', [{}])],
+                    }])
+        product, = template.products
+        return route, product
+
+    def _create_service(self):
+        "Create a subcontracted service in units"
+        pool = Pool()
+        ModelData = pool.get('ir.model.data')
+        Template = pool.get('product.template')
+
+        unit = ModelData.get_id('product', 'uom_unit')
+        template, = Template.create([{
+                    'name': 'Subcontract',
+                    'default_uom': unit,
+                    'type': 'service',
+                    'purchasable': True,
+                    'purchase_uom': unit,
+                    'list_price': Decimal(15),
+                    'products': [('create', [{
+                                    'cost_price': Decimal(10),
+                                    }])],
+                    }])
+        service, = template.products
+        return service
+
+    def _create_productions(self, route, product, count, state='draft'):
+        "Create count productions of the route up to state"
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Location = pool.get('stock.location')
+        Production = pool.get('production')
+
+        warehouse, = Location.search([('code', '=', 'WH')])
+        productions = Production.create([{
+                    'company': Transaction().context['company'],
+                    'warehouse': warehouse.id,
+                    'location': warehouse.production_location.id,
+                    'product': product.id,
+                    'unit': product.default_uom.id,
+                    'quantity': 2,
+                    'route': route.id,
+                    'planned_date': Date.today(),
+                    } for _ in range(count)])
+        Production.create_operations(productions)
+        if state in {'waiting', 'running'}:
+            Production.wait(productions)
+        if state == 'running':
+            Production.assign_try(productions)
+            Production.run(productions)
+        return Production.browse([p.id for p in productions])
+
+    def _count_queries(self, create, func):
+        "Return the number of queries of func per number of records"
+        func(create(1))
+        counts = {}
+        for size in QUERY_SIZES:
+            records = create(size)
+            with QueryCounter() as counter:
+                func(records)
+            counts[size] = counter.count
+        return counts
+
+    def assertQueriesConstant(self, counts):
+        "Assert the number of queries does not grow with the records"
+        smallest = counts[min(counts)]
+        for size, count in counts.items():
+            with self.subTest(size=size):
+                self.assertLessEqual(count, smallest,
+                    msg='%s queries for %s records' % (count, size))
+
+    @with_transaction()
+    def test_operation_cost_queries(self):
+        "Test queries to read operation cost do not grow"
+        pool = Pool()
+        ModelData = pool.get('ir.model.data')
+        Operation = pool.get('production.operation')
+        OperationTracking = pool.get('production.operation.tracking')
+
+        minute = ModelData.get_id('product', 'uom_minute')
+        company = create_company()
+        with set_company(company):
+            route, product = self._create_route()
+
+            def create(size):
+                productions = self._create_productions(
+                    route, product, size, 'running')
+                operations = [o for p in productions for o in p.operations]
+                # Different quantities to not update all costs at once
+                OperationTracking.create([{
+                            'operation': o.id,
+                            'uom': minute,
+                            'quantity': 60 + i,
+                            } for i, o in enumerate(operations)])
+                return Operation.browse([o.id for o in operations])
+
+            def read(operations):
+                Operation.read([o.id for o in operations],
+                    ['cost', 'total_quantity'])
+
+            def compute(operations):
+                Operation._get_cost(operations)
+                Operation._get_total_quantity(operations)
+
+            self.assertQueriesConstant(self._count_queries(create, read))
+            self.assertQueriesConstant(self._count_queries(create, compute))
+
+    @with_transaction()
+    def test_production_cost_queries(self):
+        "Test queries to read production cost do not grow"
+        pool = Pool()
+        Production = pool.get('production')
+
+        company = create_company()
+        with set_company(company):
+            route, product = self._create_route()
+
+            def create(size):
+                return self._create_productions(
+                    route, product, size, 'running')
+
+            def read(productions):
+                Production.read([p.id for p in productions], ['cost'])
+
+            self.assertQueriesConstant(self._count_queries(create, read))
+
+    @with_transaction()
+    def test_tracking_create_queries(self):
+        "Test queries to create and import tracking lines do not grow"
+        pool = Pool()
+        ModelData = pool.get('ir.model.data')
+        OperationTracking = pool.get('production.operation.tracking')
+
+        minute = ModelData.get_id('product', 'uom_minute')
+        company = create_company()
+        with set_company(company):
+            route, product = self._create_route()
+
+            def create(size):
+                productions = self._create_productions(
+                    route, product, size, 'running')
+                return [o for p in productions for o in p.operations]
+
+            def create_lines(operations):
+                OperationTracking.create([{
+                            'operation': o.id,
+                            'uom': minute,
+                            'quantity': 60 + i,
+                            } for i, o in enumerate(operations)])
+
+            def import_bookings(operations):
+                OperationTracking.import_bookings([{
+                            'operation': o.id,
+                            'uom': 'min',
+                            'quantity': 60 + i,
+                            } for i, o in enumerate(operations)])
+
+            self.assertQueriesConstant(
+                self._count_queries(create, create_lines))
+            self.assertQueriesConstant(
+                self._count_queries(create, import_bookings))
+
+    @with_transaction()
+    def test_operation_done_queries(self):
+        "Test queries to done operations and their productions do not grow"
+        pool = Pool()
+        ModelData = pool.get('ir.model.data')
+        Operation = pool.get('production.operation')
+        OperationTracking = pool.get('production.operation.tracking')
+
+        minute = ModelData.get_id('product', 'uom_minute')
+        company = create_company()
+        with set_company(company):
+            route, product = self._create_route()
+
+            def create(size):
+                productions = self._create_productions(
+                    route, product, size, 'running')
+                operations = [o for p in productions for o in p.operations]
+                Operation.run(operations)
+                OperationTracking.create([{
+                            'operation': o.id,
+                            'uom': minute,
+                            'quantity': 60 + i,
+                            } for i, o in enumerate(operations)])
+                return Operation.browse([o.id for o in operations])
+
+            self.assertQueriesConstant(
+                self._count_queries(create, Operation.done))
+
+    @with_transaction()
+    def test_production_do_queries(self):
+        "Test queries to do productions do not grow"
+        pool = Pool()
+        Configuration = pool.get('production.configuration')
+        Production = pool.get('production')
+        Operation = pool.get('production.operation')
+
+        company = create_company()
+        with set_company(company):
+            Configuration.write([Configuration(1)], {
+                    'allow_done_production': False,
+                    })
+            route, product = self._create_route()
+
+            def create(size):
+                productions = self._create_productions(
+                    route, product, size, 'running')
+                operations = [o for p in productions for o in p.operations]
+                Operation.run(operations)
+                Operation.done(operations)
+                return Production.browse([p.id for p in productions])
+
+            self.assertQueriesConstant(
+                self._count_queries(create, Production.do))
+
+    @with_transaction()
+    def test_work_center_load_access(self):
+        "Test work center loads are updated with access check"
+        pool = Pool()
+        ModelData = pool.get('ir.model.data')
+        Operation = pool.get('production.operation')
+        OperationTracking = pool.get('production.operation.tracking')
+        WorkCenterLoad = pool.get('production.work_center.load')
+
+        minute = ModelData.get_id('product', 'uom_minute')
+        company = create_company()
+        with set_company(company):
+            route, product = self._create_route()
+            with check_access():
+                production, = self._create_productions(
+                    route, product, 1, 'running')
+                operations = list(production.operations)
+                Operation.run(operations)
+                OperationTracking.create([{
+                            'operation': operations[0].id,
+                            'uom': minute,
+                            'quantity': 60,
+                            }])
+                Operation.done(operations)
+
+            self.assertEqual(
+                sorted((l.state, l.operations)
+                    for l in WorkCenterLoad.search([])),
+                [('done', 1), ('done', 1)])
+
+    @with_transaction()
+    def test_work_center_load_booking(self):
+        "Test work center load of booked time"
+        pool = Pool()
+        ModelData = pool.get('ir.model.data')
+        Operation = pool.get('production.operation')
+        OperationTracking = pool.get('production.operation.tracking')
+        WorkCenterLoad = pool.get('production.work_center.load')
+
+        minute = ModelData.get_id('product', 'uom_minute')
+        company = create_company()
+        with set_company(company):
+            route, product = self._create_route()
+            production, = self._create_productions(
+                route, product, 1, 'running')
+            operation = production.operations[0]
+            Operation.run([operation])
+            OperationTracking.create([{
+                        'operation': operation.id,
+                        'uom': minute,
+                        'quantity': 60,
+                        }])
+
+            load, = WorkCenterLoad.search([('state', '=', 'running')])
+            self.assertEqual(load.work_center, operation.work_center)
+            self.assertEqual(load.operations, 1)
+            self.assertEqual(load.booked_hours, 1)
+            self.assertEqual(load.cost, Decimal(25))
+
+            Operation.done([operation])
+
+            self.assertEqual(
+                WorkCenterLoad.search([('state', '=', 'running')]), [])
+            load, = WorkCenterLoad.search([('state', '=', 'done')])
+            self.assertEqual(load.booked_hours, 1)
+            self.assertEqual(load.cost, Decimal(25))
+
+    @with_transaction()
+    def test_import_bookings_errors(self):
+        "Test import bookings reports the errors per row"
+        pool = Pool()
+        Operation = pool.get('production.operation')
+        OperationTracking = pool.get('production.operation.tracking')
+
+        company = create_company()
+        with set_company(company):
+            route, product = self._create_route()
+            production, = self._create_productions(
+                route, product, 1, 'running')
+            operation = production.operations[0]
+
+            results = OperationTracking.import_bookings([{
+                        'operation': operation.id,
+                        'uom': 'min',
+                        'quantity': 30.,
+                        }, {
+                        'operation': operation.id,
+                        'uom': 'min',
+                        'quantity': 1.234,
+                        }, {
+                        'operation': operation.id,
+                        'uom': 'min',
+                        'quantity': 10.,
+                        'date': 12,
+                        }, {
+                        'operation': operation.id,
+                        'uom': 'min',
+                        'quantity': 15.,
+                        'date': dt.datetime(2100, 1, 1),
+                        }])
+
+            self.assertEqual(
+                [list(r) for r in results],
+                [['id'], ['error'], ['error'], ['id']])
+            self.assertEqual(
+                sorted(l.quantity for l in OperationTracking.search([])),
+                [15., 30.])
+            self.assertEqual(Operation(operation.id).total_quantity, 0.75)
+
+    @with_transaction()
+    def test_subcontract_purchase_request(self):
+        "Test purchase request of subcontracted operation"
+        pool = Pool()
+        Operation = pool.get('production.operation')
+
+        company = create_company()
+        with set_company(company):
+            route, product = self._create_route()
+            service = self._create_service()
+            production, = self._create_productions(route, product, 1)
+            operation, other = production.operations
+            Operation.write([operation], {
+                    'subcontracted_product': service.id,
+                    })
+
+            Operation.create_purchase_request([operation, other])
+
+            operation, other = Operation.browse([operation.id, other.id])
+            request = operation.purchase_request
+            self.assertEqual(request.product, service)
+            self.assertEqual(request.quantity, 2)
+            self.assertEqual(request.origin, operation)
+            self.assertEqual(other.purchase_request, None)
+
+    @with_transaction()
+    def test_subcontract_cost(self):
+        "Test cost of subcontracted operation without purchase"
+        pool = Pool()
+        ModelData = pool.get('ir.model.data')
+        Operation = pool.get('production.operation')
+        OperationTracking = pool.get('production.operation.tracking')
+
+        minute = ModelData.get_id('product', 'uom_minute')
+        company = create_company()
+        with set_company(company):
+            route, product = self._create_route()
+            service = self._create_service()
+            production, = self._create_productions(
+                route, product, 1, 'running')
+            operation = production.operations[1]
+            Operation.write([operation], {
+                    'subcontracted_product': service.id,
+                    })
+
+            OperationTracking.create([{
+                        'operation': operation.id,
+                        'uom': minute,
+                        'quantity': 60,
+                        }])
+
+            operation = Operation(operation.id)
+            self.assertEqual(operation.total_quantity, 1)
+            self.assertEqual(operation.cost, Decimal(20))
+
+    @with_transaction()
+    def test_operation_cost_tracking_lines(self):
+        "Test cost of operation is the sum of the cost of its lines"
+        pool = Pool()
+        ModelData = pool.get('ir.model.data')
+        Operation = pool.get('production.operation')
+        OperationTracking = pool.get('production.operation.tracking')
+
+        minute = ModelData.get_id('product', 'uom_minute')
+        company = create_company()
+        with set_company(company):
+            route, product = self._create_route()
+            production, = self._create_productions(
+                route, product, 1, 'running')
+            operation = production.operations[0]
+            OperationTracking.create([{
+                        'operation': operation.id,
+                        'uom': minute,
+                        'quantity': 1,
+                        } for _ in range(3)])
+
+            operation = Operation(operation.id)
+            # 1 minute is rounded to 0.02 hour per line
+            self.assertEqual(operation.cost, Decimal('1.50'))
+            self.assertEqual(
+                operation.cost, sum(l.cost for l in operation.lines))
+            self.assertEqual(
+                Operation._get_cost([operation]),
+                {operation.id: operation.cost})
+            self.assertAlmostEqual(operation.total_quantity, 0.06)
+
+    @with_transaction()
+    def test_operation_cost_search(self):
+        "Test search and order on cost of operations without stored cost"
+        pool = Pool()
+        ModelData = pool.get('ir.model.data')
+        Operation = pool.get('production.operation')
+        OperationTracking = pool.get('production.operation.tracking')
+
+        minute = ModelData.get_id('product', 'uom_minute')
+        company = create_company()
+        with set_company(company):
+            route, product = self._create_route()
+            production, = self._create_productions(
+                route, product, 1, 'running')
+            operation, other = production.operations
+            OperationTracking.create([{
+                        'operation': operation.id,
+                        'uom': minute,
+                        'quantity': 60,
+                        }])
+
+            self.assertEqual(other.cost_cache, None)
+            self.assertEqual(
+                Operation.search([('cost', '=', 0)]), [other])
+            self.assertEqual(
+                Operation.search([('cost', '<', 10)]), [other])
+            self.assertEqual(
+                Operation.search([('total_quantity', '>', 0)]), [operation])
+            self.assertEqual(
+                Operation.search([], order=[('cost', 'DESC')]),
+                [operation, other])
+
+    @with_transaction()
+    def test_operation_cost_work_center_cost_price(self):
+        "Test stored cost is updated with the work center cost price"
+        pool = Pool()
+        ModelData = pool.get('ir.model.data')
+        Operation = pool.get('production.operation')
+        OperationTracking = pool.get('production.operation.tracking')
+        WorkCenter = pool.get('production.work_center')
+
+        minute = ModelData.get_id('product', 'uom_minute')
+        company = create_company()
+        with set_company(company):
+            route, product = self._create_route()
+            production, = self._create_productions(
+                route, product, 1, 'running')
+            operation = production.operations[0]
+            OperationTracking.create([{
+                        'operation': operation.id,
+                        'uom': minute,
+                        'quantity': 60,
+                        }])
+            self.assertEqual(Operation(operation.id).cost, Decimal(25))
+
+            WorkCenter.write([operation.work_center], {
+                    'cost_price': Decimal(40),
+                    })
+
+            self.assertEqual(Operation(operation.id).cost, Decimal(40))
+
+    @with_transaction()
+    def test_production_get_operations(self):
+        "Test operations of production route are built by get_operation"
+        pool = Pool()
+        Production = pool.get('production')
+
+        company = create_company()
+        with set_company(company):
+            route, product = self._create_route()
+            production = Production(route=route)
+
+            operations = production._get_operations()
+
+            self.assertEqual(len(operations), 2)
+            for operation, route_operation in zip(
+                    operations, route.operations):
+                expected = production.get_operation(route_operation)
+                self.assertEqual(operation.route_operation, route_operation)
+                for name in ['sequence', 'work_center_category',
+                        'work_center', 'operation_type']:
+                    self.assertEqual(
+                        getattr(operation, name), getattr(expected, name))
+
+    @with_transaction()
+    def test_operation_schedule(self):
+        "Test planned hours and schedule of operations"
+        pool = Pool()
+        Operation = pool.get('production.operation')
+
+        company = create_company()
+        with set_company(company):
+            route, product = self._create_route()
+            production1, production2 = self._create_productions(
+                route, product, 2)
+            operation11, operation12 = production1.operations
+            operation21, operation22 = production2.operations
+            operations = [operation11, operation12, operation21, operation22]
+
+            hours = Operation.get_planned_hours(operations)
+
+            # standard: 1 hour per 3 units for 2 units, fixed: 1 hour
+            self.assertAlmostEqual(hours[operation11.id], 2 / 3)
+            self.assertAlmostEqual(hours[operation12.id], 1)
+
+            start = dt.datetime(2100, 1, 1)
+            standard = dt.timedelta(hours=hours[operation11.id])
+            fixed = dt.timedelta(hours=hours[operation12.id])
+            Operation.schedule(operations, start=start)
+
+            def second(date):
+                return date.replace(microsecond=0)
+
+            operations = Operation.browse([o.id for o in operations])
+            self.assertEqual(
+                [(second(o.planned_start_date), second(o.planned_end_date))
+                    for o in operations], [(second(b), second(e)) for b, e in [
+                        (start, start + standard),
+                        (start + standard, start + standard + fixed),
+                        (start + standard, start + 2 * standard),
+                        (start + standard + fixed,
+                            start + standard + 2 * fixed),
+                        ]])
+
+    @with_transaction()
+    def test_operation_dispatch(self):
+        "Test dispatch of operations on the queued hours of work centers"
+        pool = Pool()
+        ModelData = pool.get('ir.model.data')
+        Operation = pool.get('production.operation')
+        OperationTracking = pool.get('production.operation.tracking')
+
+        minute = ModelData.get_id('product', 'uom_minute')
+        company = create_company()
+        with set_company(company):
+            route, product = self._create_route()
+            production1, = self._create_productions(
+                route, product, 1, 'running')
+            production2, = self._create_productions(route, product, 1)
+            operation11, operation12 = production1.operations
+            operation21, operation22 = production2.operations
+            work_center1 = operation11.work_center
+            work_center2 = operation12.work_center
+            Operation.write([operation21, operation22], {
+                    'work_center': None,
+                    })
+
+            # standard: 2/3 hour on work center 1, fixed: 1 hour on 2
+            Operation.dispatch([Operation(operation21.id)])
+
+            self.assertEqual(
+                Operation(operation21.id).work_center, work_center1)
+
+            Operation.write([operation21], {
+                    'work_center': None,
+                    })
+            OperationTracking.create([{
+                        'operation': operation12.id,
+                        'uom': minute,
+                        'quantity': 60,
+                        }])
+
+            # the fixed hour is tracked so nothing is queued on 2
+            Operation.dispatch([Operation(operation21.id)])
+
+            self.assertEqual(
+                Operation(operation21.id).work_center, work_center2)
+            self.assertEqual(Operation(operation22.id).work_center, None)
+
+    @with_transaction()
+    def test_operation_schedule_subset(self):
+        "Test schedule of operations after the scheduled operations"
+        pool = Pool()
+        Operation = pool.get('production.operation')
+
+        company = create_company()
+        with set_company(company):
+            route, product = self._create_route()
+            production1, production2 = self._create_productions(
+                route, product, 2)
+            operation11, operation12 = production1.operations
+            operation21, operation22 = production2.operations
+            hours = Operation.get_planned_hours([operation11, operation12])
+            start = dt.datetime(2100, 1, 1)
+            standard = dt.timedelta(hours=hours[operation11.id])
+            fixed = dt.timedelta(hours=hours[operation12.id])
+
+            Operation.schedule([operation11, operation12], start=start)
+            Operation.schedule([operation21, operation22], start=start)
+
+            def second(date):
+                return date.replace(microsecond=0)
+
+            operations = Operation.browse([operation21.id, operation22.id])
+            self.assertEqual(
+                [(second(o.planned_start_date), second(o.planned_end_date))
+                    for o in operations], [(second(b), second(e)) for b, e in [
+                        (start + standard, start + 2 * standard),
+                        (start + standard + fixed,
+                            start + standard + 2 * fixed),
+                        ]])
+
+    @with_transaction()
+    def test_operation_analytics(self):
+        "Test operation analytics of tracked operations"
+        pool = Pool()
+        ModelData = pool.get('ir.model.data')
+        Operation = pool.get('production.operation')
+        OperationTracking = pool.get('production.operation.tracking')
+        Analytics = pool.get('production.operation.analytics')
+
+        minute = ModelData.get_id('product', 'uom_minute')
+        company = create_company()
+        with set_company(company):
+            route, product = self._create_route()
+            production1, production2 = self._create_productions(
+                route, product, 2, 'running')
+            operation11, operation12 = production1.operations
+            operation21, operation22 = production2.operations
+            # Second assembly of the same production
+            Operation.copy([operation11])
+            OperationTracking.create([{
+                        'operation': operation.id,
+                        'uom': minute,
+                        'quantity': quantity,
+                        } for operation, quantity in [
+                        (operation11, 60), (operation21, 20),
+                        (operation12, 90)]])
+
+            with Transaction().set_context(period='month'):
+                records = {
+                    r.work_center: r for r in Analytics.search([])}
+
+            self.assertEqual(len(records), 2)
+            # standard: 2/3 hour per operation, fixed: 1 hour
+            for work_center, operations, planned, actual in [
+                    (operation11.work_center, 3, 2, 4 / 3),
+                    (operation12.work_center, 2, 2, 3 / 2),
+                    ]:
+                with self.subTest(work_center=work_center.rec_name):
+                    record = records[work_center]
+                    self.assertEqual(record.operations, operations)
+                    self.assertEqual(record.quantity, 4)
+                    self.assertAlmostEqual(record.planned_hours, planned)
+                    self.assertAlmostEqual(record.actual_hours, actual)
+                    self.assertAlmostEqual(
+                        record.efficiency, planned / actual)
+                    self.assertAlmostEqual(record.throughput, 4 / actual)
+
+    @with_transaction()
+    def test_export_costing(self):
+        "Test export costing by chunks"
+        pool = Pool()
+        ModelData = pool.get('ir.model.data')
+        Operation = pool.get('production.operation')
+        OperationTracking = pool.get('production.operation.tracking')
+
+        minute = ModelData.get_id('product', 'uom_minute')
+        company = create_company()
+        with set_company(company):
+            route, product = self._create_route()
+            production1, production2 = self._create_productions(
+                route, product, 2, 'running')
+            operations = sorted(
+                production1.operations + production2.operations,
+                key=lambda o: o.id)
+            OperationTracking.create([{
+                        'operation': operations[0].id,
+                        'uom': minute,
+                        'quantity': 60,
+                        }])
+            expected = [[
+                    o.production.rec_name, o.operation_type.rec_name,
+                    o.work_center.rec_name,
+                    1. if o == operations[0] else 0.,
+                    Decimal(25) if o == operations[0] else Decimal(0),
+                    o.state] for o in operations]
+
+            chunks = list(Operation.export_costing(size=3))
+
+            self.assertEqual(len(chunks), 3)
+            header, *rows = csv.reader(''.join(chunks).splitlines())
+            self.assertEqual(header, ['production', 'operation_type',
+                    'work_center', 'total_quantity', 'cost', 'state'])
+            self.assertEqual([
+                    r[:3] + [float(r[3]), Decimal(r[4]), r[5]]
+                    for r in rows], expected)
+
+            chunks = list(Operation.export_costing(
+                    domain=[('production', '=', production1.id)],
+                    format='jsonl', size=1))
+
+            self.assertEqual(len(chunks), 2)
+            rows = [json.loads(c) for c in chunks]
+            self.assertEqual([[
+                        r['production'], r['operation_type'],
+                        r['work_center'], r['total_quantity'],
+                        Decimal(r['cost']), r['state']] for r in rows],
+                [e for o, e in zip(operations, expected)
+                    if o.production == production1])
+
+    def _create_subcontracted_operation(self):
+        "Create a subcontracted operation with its purchase request"
+        pool = Pool()
+        Operation = pool.get('production.operation')
+
+        route, product = self._create_route()
+        service = self._create_service()
+        production, = self._create_productions(route, product, 1, 'running')
+        operation = production.operations[0]
+        Operation.write([operation], {
+                'subcontracted_product': service.id,
+                })
+        Operation.create_purchase_request([operation])
+        operation = Operation(operation.id)
+        return operation, operation.purchase_request
+
+    def _create_purchase(
+            self, request, confirm=True, invoice_method='manual'):
+        "Create the purchase of the request"
+        pool = Pool()
+        Party = pool.get('party.party')
+        Purchase = pool.get('purchase.purchase')
+        Request = pool.get('purchase.request')
+
+        supplier, = Party.create([{
+                    'name': 'Supplier',
+                    'addresses': [('create', [{}])],
+                    }])
+        purchase, = Purchase.create([{
+                    'company': request.company.id,
+                    'party': supplier.id,
+                    'invoice_address': supplier.addresses[0].id,
+                    'currency': request.company.currency.id,
+                    'warehouse': request.warehouse.id,
+                    'invoice_method': invoice_method,
+                    'lines': [('create', [{
+                                    'origin': str(request.origin),
+                                    'product': request.product.id,
+                                    'quantity': request.quantity,
+                                    'unit': request.unit.id,
+                                    'unit_price': Decimal(10),
+                                    }])],
+                    }])
+        Request.write([request], {
+                'purchase_line': purchase.lines[0].id,
+                })
+        if confirm:
+            Purchase.quote([purchase])
+            Purchase.confirm([purchase])
+            Purchase.process([purchase])
+        return Purchase(purchase.id)
+
+    @with_transaction()
+    def test_subcontract_cost_purchase_user(self):
+        "Test purchase user updates the cost of subcontracted operation"
+        pool = Pool()
+        ModelData = pool.get('ir.model.data')
+        User = pool.get('res.user')
+        Operation = pool.get('production.operation')
+        PurchaseLine = pool.get('purchase.line')
+
+        company = create_company()
+        with set_company(company):
+            operation, request = self._create_subcontracted_operation()
+            purchase = self._create_purchase(request, confirm=False)
+            user, = User.create([{
+                        'name': 'Purchase',
+                        'login': 'purchase',
+                        'companies': [('add', [company.id])],
+                        'company': company.id,
+                        'groups': [('add', [
+                                    ModelData.get_id(
+                                        'purchase', 'group_purchase')])],
+                        }])
+            line, = purchase.lines
+
+            with Transaction().set_user(user.id), check_access():
+                PurchaseLine.write([line], {
+                        'unit_price': Decimal(12),
+                        })
+
+            self.assertEqual(Operation(operation.id).cost, Decimal(24))
+
+    @with_transaction()
+    def test_subcontract_done_missing_purchase(self):
+        "Test done subcontracted operation without purchase"
+        pool = Pool()
+        Operation = pool.get('production.operation')
+
+        company = create_company()
+        with set_company(company):
+            operation, request = self._create_subcontracted_operation()
+
+            with self.assertRaises(UserError) as cm:
+                Operation.done([operation])
+            self.assertIn(request.rec_name, str(cm.exception))
+
+    @with_transaction()
+    def test_subcontract_done_pending_purchase(self):
+        "Test done subcontracted operation with draft purchase"
+        pool = Pool()
+        Operation = pool.get('production.operation')
+
+        company = create_company()
+        with set_company(company):
+            operation, request = self._create_subcontracted_operation()
+            purchase = self._create_purchase(request, confirm=False)
+
+            with self.assertRaises(UserError) as cm:
+                Operation.done([operation])
+            self.assertIn(purchase.rec_name, str(cm.exception))
+
+    @with_transaction()
+    def test_subcontract_done_purchase(self):
+        "Test done subcontracted operation processes the purchase"
+        pool = Pool()
+        Operation = pool.get('production.operation')
+        Queue = pool.get('ir.queue')
+
+        company = create_company()
+        with set_company(company):
+            operation, request = self._create_subcontracted_operation()
+            purchase = self._create_purchase(request)
+            self.assertIn(purchase.state, ['processing', 'done'])
+            Queue.delete(Queue.search([]))
+
+            Operation.done([operation])
+
+            self.assertEqual(Operation(operation.id).state, 'done')
+            self.assertEqual(Queue.search([]), [])
+
+    @with_transaction()
+    def test_subcontract_done_purchase_queue(self):
+        "Test done subcontracted operation queues the purchase process"
+        pool = Pool()
+        Configuration = pool.get('production.configuration')
+        Operation = pool.get('production.operation')
+        Queue = pool.get('ir.queue')
+
+        company = create_company()
+        with set_company(company):
+            Configuration.write([Configuration(1)], {
+                    'process_purchase_queue': True,
+                    })
+            operation, request = self._create_subcontracted_operation()
+            purchase = self._create_purchase(
+                request, invoice_method='shipment')
+            self.assertEqual(purchase.state, 'processing')
+            Queue.delete(Queue.search([]))
+
+            Operation.done([operation])
+
+            self.assertEqual(Operation(operation.id).state, 'done')
+            task, = Queue.search([])
+            self.assertEqual(task.data['model'], 'purchase.purchase')
+            self.assertEqual(task.data['method'], 'process')
+            self.assertEqual(task.data['instances'], [purchase.id])
+
+    @with_transaction()
+    def test_subcontract_done_purchase_processed(self):
+        "Test done subcontracted operation skips the processed purchase"
+        pool = Pool()
+        Configuration = pool.get('production.configuration')
+        Operation = pool.get('production.operation')
+        Queue = pool.get('ir.queue')
+
+        company = create_company()
+        with set_company(company):
+            Configuration.write([Configuration(1)], {
+                    'process_purchase_queue': True,
+                    })
+            operation, request = self._create_subcontracted_operation()
+            self._create_purchase(request, invoice_method='manual')
+            Queue.delete(Queue.search([]))
+
+            Operation.done([operation])
+
+            self.assertEqual(Operation(operation.id).state, 'done')
+            self.assertEqual(Queue.search([]), [])
+
+    @with_transaction()
+    def test_operation_done_production(self):
+        "Test done last operation does the production"
+        pool = Pool()
+        Operation = pool.get('production.operation')
+        Production = pool.get('production')
+        Queue = pool.get('ir.queue')
+
+        company = create_company()
+        with set_company(company):
+            route, product = self._create_route()
+            production, = self._create_productions(
+                route, product, 1, 'running')
+            Queue.delete(Queue.search([]))
+
+            Operation.done(list(production.operations))
+
+            self.assertEqual(Production(production.id).state, 'done')
+            self.assertEqual(Queue.search([]), [])
+
+    @with_transaction()
+    def test_operation_done_production_queue(self):
+        "Test done last operation queues the production"
+        pool = Pool()
+        Configuration = pool.get('production.configuration')
+        Operation = pool.get('production.operation')
+        Production = pool.get('production')
+        Queue = pool.get('ir.queue')
+
+        company = create_company()
+        with set_company(company):
+            Configuration.write([Configuration(1)], {
+                    'done_production_queue': True,
+                    })
+            route, product = self._create_route()
+            production, = self._create_productions(
+                route, product, 1, 'running')
+            Queue.delete(Queue.search([]))
+
+            Operation.done(list(production.operations))
+
+            self.assertEqual(Production(production.id).state, 'running')
+            task, = Queue.search([])
+            self.assertEqual(task.data['model'], 'production')
+            self.assertEqual(task.data['method'], 'do')
+            self.assertEqual(task.data['instances'], [production.id])
+
 del ModuleTestCase
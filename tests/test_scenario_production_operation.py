@@ -208,6 +208,14 @@ class Test(unittest.TestCase):
         tracking.quantity = 180.0
         tracking.uom = minute
         operation1.save()
+        self.assertEqual(operation1.cost, Decimal('75'))
+        self.assertEqual(operation1.cost,
+            sum(l.cost for l in operation1.lines))
+        self.assertEqual(operation2.cost, Decimal(0))
+        self.assertEqual(operation1.total_quantity, 3.0)
+        self.assertEqual(operation2.total_quantity, 0.0)
+        self.assertEqual(
+            Operation.find([('cost', '=', Decimal('75'))]), [operation1])
         new_operation = production.operations.new()
         new_operation.work_center_category = category
         new_operation.operation_type = assembly
@@ -238,8 +246,33 @@ class Test(unittest.TestCase):
         Production.wait([production.id], config.context)
         Production.run([production.id], config.context)
         production.reload()
+
+        # Import bookings from shop floor terminals
+        operation1, operation2 = production.operations
+        result = OperationTracking.import_bookings([
+                {'operation': operation1.id, 'uom': 'min', 'quantity': 30.0},
+                {'operation': operation2.id, 'quantity': 1.0},
+                {'operation': operation2.id, 'uom': 'kg', 'quantity': 1.0},
+                ], config.context)
+        self.assertEqual(
+            [bool(r.get('id')) for r in result], [True, True, False])
+        operation1.reload()
+        self.assertEqual(operation1.total_quantity, 0.5)
+        operation2.reload()
+        self.assertEqual(operation2.total_quantity, 1.0)
+
         operations = [o.id for o in production.operations]
         Operation.run(operations, config.context)
         Operation.done(operations, config.context)
         production.reload()
         self.assertEqual(production.state, 'waiting')
+
+        # Check work center load
+        WorkCenterLoad = Model.get('production.work_center.load')
+        self.assertEqual(sorted(
+                (l.work_center.name, l.date, l.state, l.operations,
+                    l.booked_hours)
+                for l in WorkCenterLoad.find([])), [
+                ('Assembler Machine', None, 'done', 2, 3.5),
+                ('Cleaner Machine', None, 'done', 2, 1.0),
+                ])
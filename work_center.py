@@ -0,0 +1,199 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from collections import defaultdict
+from decimal import Decimal
+
+from sql.functions import CurrentTimestamp
+
+from trytond import backend
+from trytond.model import fields, ModelSQL, ModelView
+from trytond.pool import Pool, PoolMeta
+from trytond.tools import grouped_slice, reduce_ids
+from trytond.transaction import Transaction, without_check_access
+
+__all__ = ['WorkCenter', 'WorkCenterCategory', 'WorkCenterLoad']
+
+
+class WorkCenter(metaclass=PoolMeta):
+    __name__ = 'production.work_center'
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Operation = pool.get('production.operation')
+        actions = iter(args)
+        work_centers = []
+        for records, values in zip(actions, actions):
+            if {'uom', 'cost_price'} & values.keys():
+                work_centers.extend(records)
+        super(WorkCenter, cls).write(*args)
+        if work_centers:
+            Operation.update_cost_cache([
+                    ('work_center', 'in', [w.id for w in work_centers]),
+                    ])
+
+
+class WorkCenterCategory(metaclass=PoolMeta):
+    __name__ = 'production.work_center.category'
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Operation = pool.get('production.operation')
+        actions = iter(args)
+        categories = []
+        for records, values in zip(actions, actions):
+            if {'uom', 'cost_price'} & values.keys():
+                categories.extend(records)
+        super(WorkCenterCategory, cls).write(*args)
+        if categories:
+            # The total quantity is always in the unit of the category
+            Operation.update_cost_cache([
+                    ('work_center_category', 'in',
+                        [c.id for c in categories]),
+                    ])
+
+
+class WorkCenterLoad(ModelSQL, ModelView):
+    'Work Center Load'
+    __name__ = 'production.work_center.load'
+
+    work_center = fields.Many2One('production.work_center', 'Work Center',
+        required=True, readonly=True, ondelete='CASCADE')
+    date = fields.Date('Date', readonly=True)
+    state = fields.Selection([
+            ('cancelled', 'Canceled'),
+            ('planned', 'Planned'),
+            ('waiting', 'Waiting'),
+            ('running', 'Running'),
+            ('done', 'Done'),
+            ], 'State', readonly=True)
+    operations = fields.Integer('Operations', readonly=True)
+    planned_hours = fields.Float('Planned Hours', readonly=True)
+    booked_hours = fields.Float('Booked Hours', readonly=True)
+    cost = fields.Numeric('Cost', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(WorkCenterLoad, cls).__setup__()
+        cls._order.insert(0, ('date', 'ASC'))
+        cls._order.insert(1, ('work_center', 'ASC'))
+
+    @classmethod
+    def __register__(cls, module_name):
+        exist = backend.TableHandler.table_exist(cls._table)
+
+        super(WorkCenterLoad, cls).__register__(module_name)
+
+        # Migration from 7.6: build the loads of the existing operations
+        if not exist:
+            cls.rebuild()
+
+    @classmethod
+    def get_loads(cls, operations):
+        '''
+        Return the load of the operations per key (work center, date, state)
+        as a list: [operations, planned hours, booked hours, cost]
+        '''
+        pool = Pool()
+        Operation = pool.get('production.operation')
+        Uom = pool.get('product.uom')
+        ModelData = pool.get('ir.model.data')
+
+        operations = [o for o in operations if o.work_center]
+        if not operations:
+            return {}
+        hour = Uom(ModelData.get_id('product', 'uom_hour'))
+        planned = Operation.get_planned_hours(operations)
+        loads = defaultdict(lambda: [0, 0., 0., Decimal(0)])
+        for operation in operations:
+            # Use only the stored values so the load added by a write is
+            # the one removed by the next
+            load = loads[operation.get_load_key()]
+            load[0] += 1
+            load[1] += planned[operation.id]
+            load[2] += Uom.compute_qty(operation.work_center_category.uom,
+                operation.total_quantity_cache or 0., hour, round=False)
+            load[3] += operation.cost_cache or Decimal(0)
+        return loads
+
+    @classmethod
+    @without_check_access
+    def update_loads(cls, removed, added):
+        '''
+        Remove and add the loads returned by get_loads
+
+        The differences are added in SQL to the existing loads so concurrent
+        updates of the same load do not conflict and only the missing loads
+        are created.
+        The loads are maintained by the operations so the access of the user
+        is not checked.
+        '''
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+        date_field = cls._fields['date']
+
+        deltas = defaultdict(lambda: [0, 0., 0., Decimal(0)])
+        for loads, sign in [(removed, -1), (added, 1)]:
+            for key, load in loads.items():
+                delta = deltas[key]
+                for i, value in enumerate(load):
+                    delta[i] += sign * value
+        deltas = {k: d for k, d in deltas.items() if any(d)}
+        if not deltas:
+            return
+
+        to_create = []
+        for (work_center, date, state), delta in deltas.items():
+            cursor.execute(*table.update(
+                    [table.operations, table.planned_hours,
+                        table.booked_hours, table.cost,
+                        table.write_uid, table.write_date],
+                    [table.operations + delta[0],
+                        table.planned_hours + delta[1],
+                        table.booked_hours + delta[2],
+                        table.cost + delta[3],
+                        transaction.user, CurrentTimestamp()],
+                    where=(table.work_center == work_center)
+                    & (table.date == date_field.sql_format(date))
+                    & (table.state == state)))
+            if not cursor.rowcount and delta[0] > 0:
+                to_create.append({
+                        'work_center': work_center,
+                        'date': date,
+                        'state': state,
+                        'operations': delta[0],
+                        'planned_hours': delta[1],
+                        'booked_hours': delta[2],
+                        'cost': delta[3],
+                        })
+        for sub_ids in grouped_slice(list({k[0] for k in deltas})):
+            cursor.execute(*table.delete(
+                    where=reduce_ids(table.work_center, sub_ids)
+                    & (table.operations <= 0)))
+
+        # Like ModelStorage._before_write
+        transaction.counter += 1
+        for cache in transaction.cache.values():
+            cache.pop(cls.__name__, None)
+
+        if to_create:
+            cls.create(to_create)
+
+    @classmethod
+    def rebuild(cls):
+        "Rebuild the loads from all the operations"
+        pool = Pool()
+        Operation = pool.get('production.operation')
+
+        cls.delete(cls.search([]))
+        loads = defaultdict(lambda: [0, 0., 0., Decimal(0)])
+        operations = Operation.search([
+                ('work_center', '!=', None),
+                ])
+        for sub_operations in grouped_slice(operations):
+            for key, load in cls.get_loads(list(sub_operations)).items():
+                for i, value in enumerate(load):
+                    loads[key][i] += value
+        cls.update_loads({}, loads)